@@ -2,6 +2,7 @@
 #include "Board.h"
 #include "Steppers.h"
 #include "Common.h"
+#include "Protocol.h"
 
 /*
  * Let's instance a chessboard, so we have a 'Board' object available everywhere
@@ -33,9 +34,10 @@ void ChessBoard::begin(int dirX, int stepX, int dirY, int stepY, int ms1, int ms
 }
 
 void ChessBoard::resetMatrix(void) {
+  // From the h file to the a file, as x goes
   const char firstRow[] = "TCARGACT";
   for (int x = 0; x < 8; x++) {
-    MAT(this->matrix, x, 0) = firstRow[7 - x];
+    MAT(this->matrix, x, 0) = firstRow[x];
     MAT(this->matrix, x, 1) = 'P';
     for (int y = 2; y <= 5; y++) {
       MAT(this->matrix, x, y) = ' ';
@@ -61,14 +63,7 @@ void ChessBoard::attachLogger(Print& logger) {
 
 void ChessBoard::queueMovePiece(int sx, int sy, int dx, int dy, bool eliminate) {
   if (this->logger != NULL) {
-    this->logger->print("[LOG] MP ");
-    this->logger->print(sx);
-    this->logger->print(" ");
-    this->logger->print(sy);
-    this->logger->print(" ");
-    this->logger->print(dx);
-    this->logger->print(" ");
-    this->logger->println(dy);
+    Protocol.movePiece(*this->logger, sx, sy, dx, dy);
   }
   if (eliminate == true) {
     char target = MAT(this->matrix, dx, dy);
@@ -347,13 +342,23 @@ void ChessBoard::printMatrix(Print& printer) {
 }
 
 void ChessBoard::logMatrix(void) {
-  Serial.print("[LOG] ");
+  char cells[64];
   for (int x = 0; x < 8; x++) {
     for (int y = 0; y < 8; y++) {
-      Serial.write(MAT(this->matrix, x, y));
+      cells[x * 8 + y] = MAT(this->matrix, x, y);
     }
   }
-  Serial.println();
+  Protocol.matrix(Serial, cells);
+}
+
+void ChessBoard::logChecksum(void) {
+  uint8_t cells[64];
+  for (int x = 0; x < 8; x++) {
+    for (int y = 0; y < 8; y++) {
+      cells[x * 8 + y] = MAT(this->matrix, x, y);
+    }
+  }
+  Protocol.checksum(Serial, Protocol.crc(cells, 64));
 }
 
 void ChessBoard::movePiece(const piecemove move) {
@@ -364,12 +369,12 @@ void ChessBoard::movePiece(const piecemove move) {
 
   if (MAT(this->matrix, sx, sy) == ' ') {
     if (this->logger != NULL)
-      this->logger->println("[LOG] ERR_LOCATION_EMPTY");
+      Protocol.error(*this->logger, ERR_LOCATION_EMPTY);
     return;
   }
   if (MAT(this->matrix, dx, dy) != ' ') {
     if (this->logger != NULL)
-      this->logger->println("[LOG] ERR_DESTINATION_OCCUPIED");
+      Protocol.error(*this->logger, ERR_DESTINATION_OCCUPIED);
     return;
   }
 
@@ -483,7 +488,7 @@ void ChessBoard::handle(void) {
     }
 
     if (this->movementQueue.empty() && this->pieceMoveQueue.empty()) {
-      this->logger->println("[LOG] QE");
+      Protocol.queueEmpty(*this->logger);
     }
 
   } else if (!Steppers.isMoving() && this->movementQueue.empty() && !this->pieceMoveQueue.empty()) {
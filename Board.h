@@ -53,6 +53,10 @@ class ChessBoard {
        The matrix is logged to the attached logger */
     void logMatrix(void);
 
+    /* Logs the CRC-8 of the cells of the matrix, in the order logMatrix
+       sends them, so a host can check its own copy without reading it all */
+    void logChecksum(void);
+
     /* Logging: attach logger */
     void attachLogger(Print& logger);
 
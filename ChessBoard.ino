@@ -1,6 +1,7 @@
 #include "Steppers.h"
 #include "Board.h"
 #include "Common.h"
+#include "Protocol.h"
 
 String serialbuf = "";
 
@@ -19,7 +20,7 @@ void setup() {
   Board.goHome();
 
   Serial.println("Ready for commands");
-  Serial.println("[LOG] READY");
+  Protocol.ready(Serial);
 
   Board.printMatrix(Serial);
 }
@@ -49,11 +50,15 @@ void parseCommand(String command) {
     M: move piece <name> to <x>, <y> differentiating multiple candidates by <i>
     R: raw move from <sx>, <sy> to <dx>, <dy>
     X: get matrix content
+    C: get the checksum of the matrix content
+    B: switch the events to protocol <version>, 0 for text and 1 for binary frames
 
     Examples (in order):
     "MP220" (move 'pedone' to 2, 2 with i=0)
     "R2234" (move from 2, 2 to 3, 4)
     "X" (read matrix)
+    "C" (read matrix checksum)
+    "B1" (binary frames from now on)
 
     Commands ARE case sensitive: 'm' is not the same as 'M'
   */
@@ -69,9 +74,9 @@ void parseCommand(String command) {
     int dy = command[3] - '0';
     Indication i = (Indication) ((int) (command[4] - '0'));
     if (Board.queueMovePiece(piece, dx, dy, i)) {
-      Serial.println("[LOG] OK");
+      Protocol.ok(Serial);
     } else {
-      Serial.println("[LOG] ERR_WRONG_MOVE");
+      Protocol.error(Serial, ERR_WRONG_MOVE);
     }
   } else if (command[0] == 'R') {
     if (command.length() != 5)
@@ -83,6 +88,16 @@ void parseCommand(String command) {
     Board.queueMovePiece(sx, sy, dx, dy, true);
   } else if (command[0] == 'X') {
     Board.logMatrix();
+  } else if (command[0] == 'C') {
+    Board.logChecksum();
+  } else if (command[0] == 'B') {
+    if (command.length() != 2)
+      return;
+    if (Protocol.setVersion(command[1] - '0')) {
+      Protocol.protocol(Serial);
+    } else {
+      Protocol.error(Serial, ERR_PROTOCOL);
+    }
   }
 
 }
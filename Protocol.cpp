@@ -0,0 +1,133 @@
+#include <Arduino.h>
+#include "Protocol.h"
+
+/*
+ * Let's instance a protocol manager, so we have a 'Protocol' object available
+ * everywhere to report events to the host
+ */
+ProtocolManager Protocol;
+
+static const char* errorNames[] = {
+  "",
+  "ERR_WRONG_MOVE",
+  "ERR_LOCATION_EMPTY",
+  "ERR_DESTINATION_OCCUPIED",
+  "ERR_PROTOCOL"
+};
+
+static uint8_t crc8(uint8_t crc, uint8_t data) {
+  crc ^= data;
+  for (int i = 0; i < 8; i++) {
+    crc = (crc & 0x80) ? (uint8_t) ((crc << 1) ^ 0x07) : (uint8_t) (crc << 1);
+  }
+  return crc;
+}
+
+bool ProtocolManager::setVersion(int version) {
+  if (version != 0 && version != PROTOCOL_VERSION)
+    return false;
+  this->binary = (version == PROTOCOL_VERSION);
+  return true;
+}
+
+bool ProtocolManager::isBinary(void) {
+  return this->binary;
+}
+
+uint8_t ProtocolManager::crc(const uint8_t* data, uint8_t length) {
+  uint8_t crc = 0;
+  for (int i = 0; i < length; i++) {
+    crc = crc8(crc, data[i]);
+  }
+  return crc;
+}
+
+void ProtocolManager::frame(Print& out, MessageType type, const uint8_t* payload, uint8_t length) {
+  uint8_t crc = crc8(crc8(0, type), length);
+  for (int i = 0; i < length; i++) {
+    crc = crc8(crc, payload[i]);
+  }
+  out.write((uint8_t) FRAME_START);
+  out.write((uint8_t) type);
+  out.write(length);
+  out.write(payload, length);
+  out.write(crc);
+}
+
+void ProtocolManager::ready(Print& out) {
+  if (this->binary) {
+    this->frame(out, MSG_READY, NULL, 0);
+  } else {
+    out.println("[LOG] READY");
+  }
+}
+
+void ProtocolManager::ok(Print& out) {
+  if (this->binary) {
+    this->frame(out, MSG_OK, NULL, 0);
+  } else {
+    out.println("[LOG] OK");
+  }
+}
+
+void ProtocolManager::movePiece(Print& out, int sx, int sy, int dx, int dy) {
+  if (this->binary) {
+    uint8_t payload[4] = {(uint8_t) sx, (uint8_t) sy, (uint8_t) dx, (uint8_t) dy};
+    this->frame(out, MSG_MP, payload, 4);
+  } else {
+    out.print("[LOG] MP ");
+    out.print(sx);
+    out.print(" ");
+    out.print(sy);
+    out.print(" ");
+    out.print(dx);
+    out.print(" ");
+    out.println(dy);
+  }
+}
+
+void ProtocolManager::queueEmpty(Print& out) {
+  if (this->binary) {
+    this->frame(out, MSG_QE, NULL, 0);
+  } else {
+    out.println("[LOG] QE");
+  }
+}
+
+void ProtocolManager::error(Print& out, ErrorCode code) {
+  if (this->binary) {
+    uint8_t payload = code;
+    this->frame(out, MSG_ERR, &payload, 1);
+  } else {
+    out.print("[LOG] ");
+    out.println(errorNames[code]);
+  }
+}
+
+void ProtocolManager::matrix(Print& out, const char* cells) {
+  if (this->binary) {
+    this->frame(out, MSG_MATRIX, (const uint8_t*) cells, 64);
+  } else {
+    out.print("[LOG] ");
+    out.write((const uint8_t*) cells, 64);
+    out.println();
+  }
+}
+
+void ProtocolManager::protocol(Print& out) {
+  if (this->binary) {
+    uint8_t payload = PROTOCOL_VERSION;
+    this->frame(out, MSG_PROTOCOL, &payload, 1);
+  } else {
+    out.println("[LOG] PROTOCOL 0");
+  }
+}
+
+void ProtocolManager::checksum(Print& out, uint8_t crc) {
+  if (this->binary) {
+    this->frame(out, MSG_CHECKSUM, &crc, 1);
+  } else {
+    out.print("[LOG] CS ");
+    out.println(crc);
+  }
+}
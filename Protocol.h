@@ -0,0 +1,67 @@
+#ifndef _PROTOCOL_H
+#define _PROTOCOL_H
+
+
+#include <Arduino.h>
+
+/*
+ * Events reported to the host, either as "[LOG] ..." text lines or, once the
+ * host asks for it with the "B1" command, as binary frames:
+ *
+ *   0xA5, <type>, <length>, <payload...>, <crc>
+ *
+ * where <crc> is the CRC-8 (polynomial 0x07) of type, length and payload.
+ * The start byte is never part of the text the board prints, so the host can
+ * tell frames and debug prints apart.
+ */
+
+#define FRAME_START                 0xA5
+#define PROTOCOL_VERSION            1
+
+enum MessageType {
+  MSG_READY = 1,                    /* No payload */
+  MSG_OK,                           /* No payload */
+  MSG_MP,                           /* sx, sy, dx, dy as signed bytes */
+  MSG_QE,                           /* No payload */
+  MSG_ERR,                          /* ErrorCode */
+  MSG_MATRIX,                       /* 64 cells, x-major */
+  MSG_PROTOCOL,                     /* Version in use */
+  MSG_CHECKSUM                      /* CRC-8 of the 64 cells */
+};
+
+enum ErrorCode {
+  ERR_WRONG_MOVE = 1,
+  ERR_LOCATION_EMPTY,
+  ERR_DESTINATION_OCCUPIED,
+  ERR_PROTOCOL
+};
+
+class ProtocolManager {
+  public:
+    /* Switches between text (version 0) and binary frames (PROTOCOL_VERSION),
+       returning false for an unknown version */
+    bool setVersion(int version);
+    bool isBinary(void);
+
+    void ready(Print& out);
+    void ok(Print& out);
+    void movePiece(Print& out, int sx, int sy, int dx, int dy);
+    void queueEmpty(Print& out);
+    void error(Print& out, ErrorCode code);
+    void matrix(Print& out, const char* cells);
+    void protocol(Print& out);
+    void checksum(Print& out, uint8_t crc);
+
+    /* CRC-8 (polynomial 0x07) of <length> bytes, as in the frames */
+    uint8_t crc(const uint8_t* data, uint8_t length);
+
+  private:
+    bool binary = false;
+
+    void frame(Print& out, MessageType type, const uint8_t* payload, uint8_t length);
+};
+
+extern ProtocolManager Protocol;
+
+
+#endif
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Batch analysis of finished games. Every position of every game is searched,
+# and each move is given the score of the position before it, the engine's
+# best move there, and how much it lost against that best move, moves losing
+# more than the blunder threshold being flagged:
+#
+#   python analyse.py games.pgn --depth 5 --workers 4 > analysis.jsonl
+#
+# Games are read from PGN files or files with one game per line, as for the
+# opening book, and written as one JSON object per line, in the order of the
+# input. Games are handed to a pool of processes, each with a searcher of its
+# own, and only a few games per process are ever read ahead, so memory stays
+# bounded whatever the number of games.
+#
+# Scores are in centipawns, from white's point of view for the positions and
+# from the mover's for the losses.
+
+from __future__ import print_function
+import sys, json, argparse, multiprocessing
+from collections import deque
+import sunfish
+import sunfish_glue
+import book
+
+BLUNDER = 200
+
+_searcher = None
+
+def _init_worker(engine, table_bytes):
+    global _searcher
+    _searcher = __import__(engine).Searcher(table_bytes)
+
+def analyse_game(args):
+    ''' Analysis of the moves of a game, stopping at the first move that
+    can't be read '''
+    number, game, depth, blunder = args
+    pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+    positions, moves = [pos], []
+    for ply, text in enumerate(game):
+        move = book.read_move(pos, text, ply % 2 == 1)
+        if move is None:
+            break
+        pos = pos.move(move)
+        positions.append(pos)
+        moves.append((text, move))
+    # Best move and score of each position from the side to move, and the
+    # score of the position each move leads to, searched a ply less for both
+    # scores to look as far ahead
+    searches = [_searcher.search(pos, limits=sunfish.TimeManager(depth=depth)) for pos in positions[:-1]]
+    replies = [_searcher.search(pos, limits=sunfish.TimeManager(depth=max(depth - 1, 1)))[1]
+               for pos in positions[1:]]
+    analysis = []
+    for ply, (text, move) in enumerate(moves):
+        black = ply % 2 == 1
+        best, score = searches[ply]
+        # The move scores what the opponent's best reply leaves. The searches
+        # are still separate ones, so the best move itself loses nothing.
+        loss = 0 if move == best else score + replies[ply]
+        analysis.append({
+            'ply': ply + 1, 'move': text,
+            'score': -score if black else score,
+            'best': None if best is None else sunfish_glue.sunfishToCoordinateMove(best, black),
+            'loss': max(loss, 0), 'blunder': loss >= blunder})
+    result = {'game': number, 'moves': analysis}
+    if len(moves) < len(game):
+        result['error'] = 'unreadable move %s' % game[len(moves)]
+    return result
+
+def analyse(games, depth, workers, engine='sunfish', table_bytes=sunfish.TABLE_BYTES, blunder=BLUNDER):
+    ''' Yields the analysis of each of the games, in order, keeping at most
+    two games per worker in flight. Each worker has a table of table_bytes. '''
+    pool = multiprocessing.Pool(workers, _init_worker, (engine, table_bytes))
+    try:
+        pending = deque()
+        for number, game in enumerate(games, 1):
+            pending.append(pool.apply_async(analyse_game, ((number, game, depth, blunder),)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyse the moves of finished games')
+    parser.add_argument('games', nargs='+', help='.pgn files, or files with one game per line')
+    parser.add_argument('--depth', type=int, default=4, help='search depth of each position')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--engine', default='sunfish', choices=('sunfish', 'sunfish_board', 'sunfish_numpy'))
+    parser.add_argument('--table-mb', type=int, help='transposition table size of each worker')
+    parser.add_argument('--blunder', type=int, default=BLUNDER, help='centipawns lost to flag a move')
+    args = parser.parse_args()
+
+    table_bytes = sunfish.TABLE_BYTES if args.table_mb is None else args.table_mb << 20
+    games = (game for path in args.games for game in book.read_games(path))
+    blunders = 0
+    for result in analyse(games, args.depth, args.workers, args.engine, table_bytes, args.blunder):
+        blunders += sum(1 for m in result['moves'] if m['blunder'])
+        print(json.dumps(result))
+        sys.stdout.flush()
+        if 'error' in result:
+            print('Game %d: %s' % (result['game'], result['error']), file=sys.stderr)
+    print('%d blunders' % blunders, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,563 @@
+# -*- coding: utf8 -*-
+
+# Serial link to the Arduino running the ChessBoard firmware.
+# A background thread reads every line the board sends and parses the [LOG]
+# ones into events, which are kept in a short history and handed to the
+# callers waiting for them, so nothing the board says is lost while the host
+# is busy searching or talking. Each event has a sequence number, and waiting
+# callers only look at the events that came after the command they sent.
+#
+# Events are named after the first token of the line:
+#  READY                  the firmware started
+#  OK                     an M command was accepted
+#  MP <sx> <sy> <dx> <dy> a piece move was queued, destinations off the
+#                         8x8 board being the graveyard of eliminated pieces
+#  QE                     the move queue is empty, all moves are done
+#  ERR_<reason>           a command failed
+#  MATRIX <content>       the 64 squares of the board, answering X
+#  PROTOCOL <version>     the events protocol was switched, answering B
+#  CS <crc>               the CRC-8 of the matrix content, answering C
+# Lines without the [LOG] prefix are TEXT events, the debug prints of the
+# firmware, which are never kept in the history.
+#
+# Once asked with the B1 command, the board sends the same events as binary
+# frames instead (see Protocol.h in the firmware):
+#  0xA5, <type>, <length>, <payload...>, <crc>
+# which are decoded from the same stream as the text, the start byte never
+# appearing in the debug prints.
+
+import time
+import struct
+import threading
+from collections import deque, namedtuple
+
+# <line> is None for the events sent as binary frames
+Event = namedtuple('Event', 'seq kind args line')
+
+LOG_PREFIX = '[LOG] '
+
+# This function parses a line sent by the board into the kind and the
+# arguments of its event
+def parseLine(line):
+    if not line.startswith(LOG_PREFIX):
+        return 'TEXT', ()
+    body = line[len(LOG_PREFIX):]
+    # The matrix dump is the only line of exactly 64 characters, spaces
+    # included, as they are the empty squares
+    if len(body) == 64:
+        return 'MATRIX', (body,)
+    tokens = body.split()
+    if len(tokens) == 0:
+        return 'TEXT', ()
+    if tokens[0] in ('MP', 'CS'):
+        try:
+            args = tuple(int(t) for t in tokens[1:])
+        except ValueError:
+            return 'TEXT', ()
+        if len(args) != (4 if tokens[0] == 'MP' else 1):
+            return 'TEXT', ()
+        return tokens[0], args
+    return tokens[0], tuple(tokens[1:])
+
+FRAME_START = b'\xa5'
+PROTOCOL_VERSION = 1
+
+# Message types of the binary frames, MessageType in Protocol.h
+MSG_READY, MSG_OK, MSG_MP, MSG_QE, MSG_ERR, MSG_MATRIX, MSG_PROTOCOL, MSG_CHECKSUM = range(1, 9)
+ERRORS = {1: 'ERR_WRONG_MOVE', 2: 'ERR_LOCATION_EMPTY', 3: 'ERR_DESTINATION_OCCUPIED',
+          4: 'ERR_PROTOCOL'}
+
+MP_PAYLOAD = struct.Struct('4b')
+
+def makeCrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xff
+        table.append(crc)
+    return table
+
+CRC_TABLE = makeCrcTable()
+
+# This function returns the CRC-8 (polynomial 0x07) of a bytearray
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC_TABLE[crc ^ byte]
+    return crc
+
+# This function returns the frame of a message, as the board sends it
+def encodeFrame(msgType, payload=b''):
+    body = bytearray([msgType, len(payload)]) + bytearray(payload)
+    return bytes(bytearray(FRAME_START) + body + bytearray([crc8(body)]))
+
+# This function decodes the type and payload of a frame into the kind and the
+# arguments of its event, or None for unknown messages
+def decodeMessage(msgType, payload):
+    if msgType == MSG_MP and len(payload) == 4:
+        return 'MP', MP_PAYLOAD.unpack(bytes(payload))
+    if msgType == MSG_ERR and len(payload) == 1:
+        return ERRORS.get(payload[0], 'ERR_UNKNOWN'), ()
+    if msgType == MSG_MATRIX and len(payload) == 64:
+        return 'MATRIX', (payload.decode('ascii', 'replace'),)
+    if msgType == MSG_PROTOCOL and len(payload) == 1:
+        return 'PROTOCOL', (payload[0],)
+    if msgType == MSG_CHECKSUM and len(payload) == 1:
+        return 'CS', (payload[0],)
+    if msgType in (MSG_READY, MSG_OK, MSG_QE):
+        return {MSG_READY: 'READY', MSG_OK: 'OK', MSG_QE: 'QE'}[msgType], ()
+    return None
+
+# Splits the bytes read from the board into frames and text lines, either of
+# which may be cut across reads
+class StreamDecoder:
+    def __init__(self):
+        self.buf = bytearray()
+
+    # This method returns the (kind, args, line) of the events completed by
+    # <data>
+    def feed(self, data):
+        self.buf += data
+        events = []
+        while self.buf:
+            start = self.buf.find(FRAME_START)
+            if start != 0:
+                # Text, up to the next frame or the last complete line
+                end = start if start > 0 else self.buf.rfind(b'\n') + 1
+                if end == 0:
+                    break
+                for line in self.buf[:end].decode('ascii', 'replace').splitlines():
+                    kind, args = parseLine(line)
+                    events.append((kind, args, line))
+                del self.buf[:end]
+                continue
+            if len(self.buf) < 3:
+                break
+            end = 3 + self.buf[2] + 1
+            if len(self.buf) < end:
+                break
+            if crc8(self.buf[1:end - 1]) != self.buf[end - 1]:
+                # Not a frame, or a corrupted one: look for the next start
+                del self.buf[:1]
+                continue
+            event = decodeMessage(self.buf[1], self.buf[3:end - 1])
+            if event is not None:
+                events.append(event + (None,))
+            del self.buf[:end]
+        return events
+
+class SerialLink:
+    def __init__(self, port, history=256, verbose=True):
+        # <port> is an open serial.Serial, or anything with the same
+        # read/write/close methods and in_waiting, whose read times out
+        self.port = port
+        self.events = deque(maxlen=history)
+        self.seq = 0
+        # Sequence number of the last event before the last command sent
+        self.mark = 0
+        self.cond = threading.Condition()
+        # Functions called with every event, TEXT ones included, from the
+        # reader thread
+        self.listeners = []
+        # Whether to print the events and the commands
+        self.verbose = verbose
+        self.stopped = False
+        self.reader = threading.Thread(target=self.readLoop)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def readLoop(self):
+        decoder = StreamDecoder()
+        while not self.stopped:
+            # Whatever has come, or else the next byte: waiting for a whole
+            # line would hold the frames, which don't end with one, until the
+            # read times out
+            data = self.port.read(self.port.in_waiting or 1)
+            if data:
+                for kind, args, line in decoder.feed(data):
+                    self.dispatch(kind, args, line)
+
+    def dispatch(self, kind, args, line):
+        if not self.verbose:
+            pass
+        elif line is None:
+            print("[SERIAL] frame: " + kind + " " + " ".join(str(a) for a in args))
+        elif kind != 'TEXT':
+            print("[SERIAL] parsing line: " + line)
+        with self.cond:
+            self.seq += 1
+            event = Event(self.seq, kind, args, line)
+            if kind != 'TEXT':
+                self.events.append(event)
+                self.cond.notify_all()
+        for listener in self.listeners:
+            listener(event)
+
+    # This method sends a command to the board, returning the sequence number
+    # of the last event received before it
+    def send(self, command):
+        with self.cond:
+            self.mark = self.seq
+        if self.verbose:
+            print("[SERIAL] send: \"" + command + "\"")
+        self.port.write((command + '\n').encode('ascii'))
+        return self.mark
+
+    # This method waits for the first event after the sequence number <after>
+    # (by default the last event before the last command sent) accepted by
+    # <accept>, either a function of the event or a tuple of event kinds.
+    # Returns the event, or None if none came within <timeout> seconds
+    def waitFor(self, accept, timeout, after=None):
+        if not callable(accept):
+            kinds = accept
+            accept = lambda event: event.kind in kinds
+        if after is None:
+            after = self.mark
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for event in self.events:
+                    if event.seq > after and accept(event):
+                        return event
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    # This method asks the board to send its events as binary frames,
+    # returning whether it does. Boards with older firmware don't answer and
+    # keep sending text lines, which are still understood
+    def useBinaryProtocol(self, timeout=1):
+        self.send('B' + str(PROTOCOL_VERSION))
+        event = self.waitFor(('PROTOCOL', 'ERR_PROTOCOL'), timeout)
+        return event is not None and event.kind == 'PROTOCOL' and int(event.args[0]) == PROTOCOL_VERSION
+
+    def close(self):
+        self.stopped = True
+        self.reader.join()
+        self.port.close()
+
+# Number of piece moves the firmware queues, pieceMoveQueue in Board.h
+PIECE_QUEUE_SIZE = 8
+
+class CommandError(Exception):
+    pass
+
+class CommandTimeout(CommandError):
+    pass
+
+# A command sent through a CommandPipeline, which is the future of its answer
+# and of the end of the moves it started
+class Command:
+    def __init__(self, text):
+        self.text = text
+        self.kind = text[0]
+        # Arguments of the MP events answering the command, the moves of the
+        # eliminated pieces first
+        self.moves = []
+        # Errors the board reported while carrying out its moves
+        self.errors = []
+        self.answer = None
+        self.error = None
+        self.acked = threading.Event()
+        self.finished = threading.Event()
+
+    # This method returns the answer of the board, the list of moves for M,
+    # the move for R, the matrix content for X and its checksum for C, raising a CommandError if
+    # it refused the command or didn't answer within <timeout> seconds
+    def result(self, timeout=None):
+        if not self.acked.wait(timeout):
+            raise CommandTimeout("no answer to " + self.text)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+    # Whether the command was answered and its moves, if any, carried out
+    def done(self):
+        return self.finished.is_set()
+
+    # This method waits for the command to be done, returning False if a
+    # timeout occurred
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+# Keeps several commands in flight on the link, so sequences of moves stream
+# to the board instead of waiting for each move to end before sending the next.
+# The firmware answers commands in the order it receives them, so each answer
+# goes to the oldest command not answered yet, and the queue empty event ends
+# all the moves started so far. Note that the firmware finds the piece of an
+# M command, and whether a move eliminates one, on the board as it is when the
+# command arrives: commands depending on moves still in progress must wait for
+# them with drain().
+class CommandPipeline:
+    def __init__(self, link, depth=PIECE_QUEUE_SIZE // 2):
+        # Every move may queue a second one to eliminate a piece, so at most
+        # <depth> move commands are in flight
+        self.link = link
+        self.depth = depth
+        self.cond = threading.Condition()
+        # Commands sent and not answered yet, oldest first
+        self.unacked = deque()
+        # Move commands answered whose moves aren't done yet
+        self.moving = deque()
+        link.listeners.append(self.onEvent)
+
+    def inFlight(self):
+        return sum(1 for c in self.unacked if c.kind in 'MR') + len(self.moving)
+
+    def waitUntil(self, condition, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while not condition():
+            if deadline is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    # This method sends a command once there's room for it, returning its
+    # Command. Raises a CommandTimeout if there's no room within <timeout>
+    def submit(self, text, timeout=None):
+        command = Command(text)
+        with self.cond:
+            if command.kind in 'MR':
+                if not self.waitUntil(lambda: self.inFlight() < self.depth, timeout):
+                    raise CommandTimeout("pipeline full, " + text + " not sent")
+            self.unacked.append(command)
+            self.link.send(text)
+        return command
+
+    # This method waits for all the commands sent to be done, returning False
+    # if a timeout occurred
+    def drain(self, timeout=None):
+        with self.cond:
+            return self.waitUntil(lambda: not self.unacked and not self.moving, timeout)
+
+    def ack(self, command, answer):
+        self.unacked.popleft()
+        command.answer = answer
+        command.acked.set()
+        if command.kind in 'MR':
+            self.moving.append(command)
+        else:
+            command.finished.set()
+
+    def fail(self, command, error):
+        command.error = error
+        command.acked.set()
+        command.finished.set()
+
+    def onEvent(self, event):
+        with self.cond:
+            head = self.unacked[0] if self.unacked else None
+            kind = head.kind if head is not None else None
+            if event.kind == 'MP' and kind in ('M', 'R'):
+                head.moves.append(event.args)
+                if kind == 'R':
+                    self.ack(head, event.args)
+            elif event.kind == 'OK' and kind == 'M':
+                self.ack(head, head.moves)
+            elif event.kind == 'ERR_WRONG_MOVE' and kind == 'M':
+                self.fail(self.unacked.popleft(), CommandError(event.kind))
+            elif event.kind == 'MATRIX' and kind == 'X':
+                self.ack(head, event.args[0])
+            elif event.kind == 'CS' and kind == 'C':
+                self.ack(head, event.args[0])
+            elif event.kind == 'QE':
+                while self.moving:
+                    self.moving.popleft().finished.set()
+            elif event.kind.startswith('ERR_') and self.moving:
+                # Moves are carried out in order, so the error is about the
+                # oldest command still moving
+                self.moving[0].errors.append(event.kind)
+            elif event.kind == 'READY':
+                # The board restarted, forgetting every command
+                while self.unacked:
+                    self.fail(self.unacked.popleft(), CommandError("board restarted"))
+                while self.moving:
+                    self.fail(self.moving.popleft(), CommandError("board restarted"))
+            self.cond.notify_all()
+
+# The cells of the board at the start of a game, as resetMatrix in Board.cpp
+# sets them, by x then y
+def initialCells():
+    firstRow = "TCARGACT"
+    return ''.join(firstRow[x] + 'P' + ' ' * 4 + 'p' + firstRow[x].lower() for x in range(8))
+
+# The board as the host expects it once the moves sent so far are carried
+# out, graveyards included. It follows the MP events of the link, so it is
+# known without asking the board for its matrix, which is only read to check
+# the model once in a while or when the board reported an error.
+# The board doesn't know about promotions, a promoted pawn staying a pawn for
+# it, so they are told to the model with promote() and only change what it
+# reports, not what it compares with the board.
+class BoardModel:
+    def __init__(self, link, verifyInterval=20):
+        self.lock = threading.Lock()
+        # Moves after which the model is checked against the board
+        self.verifyInterval = verifyInterval
+        # Whether the board answers the C command, else the whole matrix is
+        # read to check the model
+        self.useChecksum = False
+        self.reset()
+        link.listeners.append(self.onEvent)
+
+    def reset(self):
+        with self.lock:
+            # Columns x = -2 to 9 by rows y = 0 to 7, like the firmware matrix
+            self.cells = [[' '] * 12 for y in range(8)]
+            for n, c in enumerate(initialCells()):
+                self.cells[n % 8][n // 8 + 2] = c
+            # Letters of the promoted pieces by square
+            self.promoted = {}
+            self.movesSinceCheck = 0
+            self.suspect = False
+
+    def onEvent(self, event):
+        if event.kind == 'MP':
+            self.applyMove(*event.args)
+        elif event.kind == 'READY':
+            self.reset()
+        elif event.kind in ('ERR_LOCATION_EMPTY', 'ERR_DESTINATION_OCCUPIED'):
+            # The board skipped a move the model made
+            self.suspect = True
+
+    # getGraveyard of Board.cpp: the last free cell of the two graveyard
+    # columns of the player, white ones being on the right
+    def graveyard(self, white):
+        startX = -2 + (10 if white else 0)
+        cell = None
+        for y in range(8):
+            for x in range(startX, startX + 2):
+                if self.cells[y][x + 2] == ' ':
+                    cell = (x, y)
+                    break
+        return cell
+
+    def move(self, sx, sy, dx, dy):
+        self.cells[dy][dx + 2] = self.cells[sy][sx + 2]
+        self.cells[sy][sx + 2] = ' '
+        if (sx, sy) in self.promoted:
+            self.promoted[(dx, dy)] = self.promoted.pop((sx, sy))
+
+    def applyMove(self, sx, sy, dx, dy):
+        with self.lock:
+            target = self.cells[dy][dx + 2]
+            if target != ' ':
+                # Raw moves eliminate the piece they land on without an MP
+                # event of its own
+                cell = self.graveyard(target.isupper())
+                if cell is not None:
+                    self.move(dx, dy, cell[0], cell[1])
+            self.move(sx, sy, dx, dy)
+            self.movesSinceCheck += 1
+
+    # This method records that the pawn on <x>, <y> was promoted to <piece>
+    def promote(self, x, y, piece):
+        with self.lock:
+            self.promoted[(x, y)] = piece
+
+    # This method returns the piece on a square, ' ' for empty ones
+    def get(self, x, y):
+        with self.lock:
+            return self.promoted.get((x, y), self.cells[y][x + 2])
+
+    # This method returns the board as a matrix[x][y] of pieces, like
+    # daemon.getMatrix
+    def matrix(self):
+        with self.lock:
+            return [[self.promoted.get((x, y), self.cells[y][x + 2]) for y in range(8)] for x in range(8)]
+
+    # The 64 cells as the board knows them, in the order of the X command
+    def content(self):
+        with self.lock:
+            return ''.join(self.cells[y][x + 2] for x in range(8) for y in range(8))
+
+    def needsCheck(self):
+        return self.suspect or self.movesSinceCheck >= self.verifyInterval
+
+    # This method compares the model with the board, which must have carried
+    # out all its moves, through the checksum of the matrix when the board
+    # answers it, and reads the matrix in full when they differ, adopting it.
+    # Returns True if they matched
+    def verify(self, pipeline, timeout=2):
+        content = self.content()
+        if self.useChecksum:
+            if pipeline.submit('C').result(timeout) == crc8(bytearray(content.encode('ascii'))):
+                self.movesSinceCheck = 0
+                self.suspect = False
+                return True
+        board = pipeline.submit('X').result(timeout)
+        with self.lock:
+            for n, c in enumerate(board):
+                x, y = n // 8, n % 8
+                self.cells[y][x + 2] = c
+                if (x, y) in self.promoted and c.lower() != 'p':
+                    del self.promoted[(x, y)]
+            self.movesSinceCheck = 0
+            self.suspect = False
+        return board == content
+
+if __name__ == "__main__":
+    summary = {
+        'tests': 0,
+        'passed': 0
+    }
+
+    def test(name, r, e):
+        print("[TEST] \"" + name + "\" ->"),
+        summary['tests'] += 1
+        if r == e:
+            summary['passed'] += 1
+            print("*PASS*"),
+            print("result=" + str(r))
+        else:
+            print("ERROR!"),
+            print(str(r) + " but expected " + str(e))
+
+    def printSummary():
+        print("")
+        print("Passed " + str(summary['passed']) + " out of " + str(summary['tests']) + " tests")
+        print("")
+
+    # A port handing out <chunks>, none ending a line, then nothing until
+    # each read times out after <timeout> seconds, as serial.Serial does
+    class FakePort:
+        def __init__(self, chunks, timeout=1):
+            self.chunks = deque(chunks)
+            self.timeout = timeout
+
+        @property
+        def in_waiting(self):
+            return len(self.chunks[0]) if self.chunks else 0
+
+        def read(self, size=1):
+            if not self.chunks:
+                time.sleep(self.timeout)
+                return b''
+            data = self.chunks.popleft()
+            if size < len(data):
+                self.chunks.appendleft(data[size:])
+            return data[:size]
+
+        def write(self, data):
+            return len(data)
+
+        def close(self):
+            pass
+
+    frame = encodeFrame(MSG_MP, MP_PAYLOAD.pack(1, 0, 2, 2))
+    link = SerialLink(FakePort([frame[:3], frame[3:], b'[LOG] QE\r\n[LOG] O', b'K']), verbose=False)
+    start = time.time()
+    event = link.waitFor(('MP',), 0.5, after=0)
+    test("read_frame", (event.kind, event.args), ('MP', (1, 0, 2, 2)))
+    test("read_frame_before_timeout", time.time() - start < 0.5, True)
+    event = link.waitFor(('QE',), 0.5, after=0)
+    test("read_line", event.kind, 'QE')
+    test("read_unfinished_line", link.waitFor(('OK',), 0.1, after=0), None)
+    link.close()
+
+    printSummary()
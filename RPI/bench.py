@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Engine benchmark. A fixed set of positions is searched to a fixed depth and
+# for a fixed time, with fresh tables for each search, and the results are
+# printed as JSON. The fixed depth searches are deterministic, so their node
+# counts only change with the engine itself, while nodes per second and time
+# to depth tell how fast the machine runs it.
+#
+#   python bench.py --engine sunfish_board --depth 6 --secs 2 > board.json
+
+from __future__ import print_function
+import sys, time, json, argparse, resource, platform
+import sunfish
+import sunfish_glue
+
+POSITIONS = [
+    ('opening', 'initial',
+        'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'),
+    ('opening', 'italian',
+        'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'),
+    ('middlegame', 'kiwipete',
+        'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'),
+    ('middlegame', 'queens_gambit',
+        'r1bq1rk1/pp2bppp/2n1pn2/2pp4/2PP4/2N1PN2/PP1BBPPP/R2QK2R w KQ - 0 8'),
+    ('endgame', 'rook_pawns',
+        '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1'),
+    ('endgame', 'king_pawn',
+        '8/8/8/4k3/8/8/4P3/4K3 w - - 0 1'),
+    ('tactical', 'wac001',
+        '2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - 0 1'),
+    ('tactical', 'wac002',
+        '8/7p/5k2/5p2/p1p2P2/Pr1pPK2/1P1R3P/8 b - - 0 1'),
+]
+
+def hit_rate(searcher):
+    stats = searcher.tp_score.stats()
+    probes = stats['hits'] + stats['misses']
+    return stats['hits'] / float(probes) if probes else 0.
+
+def peak_rss():
+    ''' Peak resident set size of the process so far, in kilobytes '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def render(move, black):
+    return None if move is None else sunfish_glue.sunfishToCoordinateMove(move, black)
+
+def bench_depth(engine, pos, black, depth, table_bytes):
+    ''' Iterative deepening of pos up to depth, timing every iteration '''
+    searcher = engine.Searcher(table_bytes)
+    searcher.new_search()
+    start = time.time()
+    iterations = []
+    for _ in searcher._search(searcher._position(pos)):
+        iterations.append({
+            'depth': searcher.depth, 'nodes': searcher.nodes,
+            'secs': round(time.time() - start, 4)})
+        if searcher.depth >= depth:
+            break
+    secs = time.time() - start
+    return {
+        'move': render(searcher.tp_move.get(pos.key), black),
+        'nodes': searcher.nodes, 'secs': round(secs, 4),
+        'nps': int(searcher.nodes / secs) if secs else 0,
+        'tt_hit_rate': round(hit_rate(searcher), 4),
+        'iterations': iterations}
+
+def bench_time(engine, pos, black, secs, table_bytes):
+    ''' The search the computer player would run in pos, given secs '''
+    searcher = engine.Searcher(table_bytes)
+    start = time.time()
+    move, score = searcher.search(pos, secs)
+    elapsed = time.time() - start
+    return {
+        'move': render(move, black), 'score': score, 'depth': searcher.depth,
+        'nodes': searcher.nodes, 'secs': round(elapsed, 4),
+        'nps': int(searcher.nodes / elapsed) if elapsed else 0,
+        'tt_hit_rate': round(hit_rate(searcher), 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the chess engine')
+    parser.add_argument('--engine', default='sunfish', choices=('sunfish', 'sunfish_board', 'sunfish_numpy'))
+    parser.add_argument('--depth', type=int, default=6, help='depth of the fixed depth searches')
+    parser.add_argument('--secs', type=float, default=2, help='time of the fixed time searches')
+    parser.add_argument('--table-mb', type=int, default=sunfish.TABLE_BYTES >> 20)
+    parser.add_argument('--only', nargs='*', help='names or kinds of the positions to run')
+    args = parser.parse_args()
+
+    engine = __import__(args.engine)
+    table_bytes = args.table_mb << 20
+    results = []
+    for kind, name, fen in POSITIONS:
+        if args.only and kind not in args.only and name not in args.only:
+            continue
+        pos = sunfish_glue.fenToSunfishPosition(fen)
+        black = fen.split()[1] == 'b'
+        results.append({
+            'kind': kind, 'name': name, 'fen': fen,
+            'fixed_depth': bench_depth(engine, pos, black, args.depth, table_bytes),
+            'fixed_time': bench_time(engine, pos, black, args.secs, table_bytes)})
+
+    nodes = sum(r['fixed_depth']['nodes'] for r in results)
+    secs = sum(r['fixed_depth']['secs'] for r in results)
+    print(json.dumps({
+        'engine': args.engine, 'python': platform.python_version(),
+        'machine': platform.machine(), 'depth': args.depth, 'secs': args.secs,
+        'table_bytes': table_bytes,
+        'total': {'nodes': nodes, 'secs': round(secs, 4),
+                  'nps': int(nodes / secs) if secs else 0},
+        'peak_rss_kb': peak_rss(),
+        'positions': results}, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
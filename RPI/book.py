@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Opening book. The book is a file of fixed size records, sorted by the
+# Zobrist key of the position they are about:
+#
+#   header:  4s magic 'SFBK', I number of records
+#   record:  Q key, H move (from * 120 + to), H weight
+#
+# all little endian. The file is memory-mapped and binary searched, so opening
+# a book costs nothing however large it is, and only the pages holding the
+# probed records are ever read. Keys and moves are those of sunfish, where the
+# side to move always plays up the board, and the keys stay the same across
+# runs as the Zobrist tables are seeded.
+#
+# Books are built from PGN files, or from text files with one game per line,
+# in algebraic or coordinate notation, read a game at a time:
+#
+#   python book.py build book.bin openings.txt games.pgn --plies 20
+
+from __future__ import print_function
+import re, sys, mmap, struct, random, argparse
+from collections import defaultdict
+import sunfish
+import sunfish_glue
+
+MAGIC = b'SFBK'
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<QHH')
+
+class Book:
+    ''' Read only view of a book file '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or HEADER.size + self.size * RECORD.size > len(self.map):
+            self.close()
+            raise ValueError('%s is not a book file' % path)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _record(self, n):
+        return RECORD.unpack_from(self.map, HEADER.size + n * RECORD.size)
+
+    def moves(self, key):
+        ''' The moves stored for the position with the given key, and their
+        weights, heaviest first '''
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        moves = []
+        while lo < self.size:
+            k, move, weight = self._record(lo)
+            if k != key:
+                break
+            moves.append((divmod(move, 120), weight))
+            lo += 1
+        return moves
+
+    def choose(self, pos, rnd=random):
+        ''' A book move for pos picked at random by weight, or None when pos is
+        out of book. Moves that aren't legal in pos, which would come from a
+        key collision, are never returned. '''
+        legal = sunfish_glue.legalSunfishMoves(pos)
+        moves = [(m, w) for m, w in self.moves(pos.key) if m in legal]
+        if not moves:
+            return None
+        pick = rnd.uniform(0, sum(w for m, w in moves))
+        for move, weight in moves:
+            pick -= weight
+            if pick <= 0:
+                return move
+        return moves[-1][0]
+
+###############################################################################
+# Building
+###############################################################################
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+COORDINATE = re.compile(r'^[a-h][1-8][a-h][1-8][qQ]?$')
+
+def pgn_games(text):
+    ''' Yields the moves of each game of a PGN text, with the tags, comments,
+    variations, annotations and move numbers left out '''
+    text = re.sub(r'\{[^}]*\}|;[^\n]*|\[[^\]]*\]|\$\d+', ' ', text)
+    while True:
+        stripped = re.sub(r'\([^()]*\)', ' ', text)
+        if stripped == text:
+            break
+        text = stripped
+    game = []
+    for token in text.split():
+        token = re.sub(r'^\d+\.+', '', token)
+        if token in RESULTS:
+            yield game
+            game = []
+        elif token:
+            game.append(token)
+    if game:
+        yield game
+
+def pgn_file_games(lines):
+    ''' Yields the moves of each game of a PGN file, reading it a game at a
+    time, so files of any size take little memory '''
+    chunk, moves = [], False
+    for line in lines:
+        # The tags of a game start after the moves of the previous one
+        if line.startswith('[') and moves:
+            for game in pgn_games(''.join(chunk)):
+                yield game
+            chunk, moves = [], False
+        chunk.append(line)
+        moves = moves or (line.strip() and not line.startswith('['))
+    for game in pgn_games(''.join(chunk)):
+        yield game
+
+def list_games(lines):
+    ''' Yields the moves of each line of a text file, ignoring # comments '''
+    for line in lines:
+        game = [re.sub(r'^\d+\.+', '', t) for t in line.split('#')[0].split()]
+        game = [t for t in game if t and t not in RESULTS]
+        if game:
+            yield game
+
+def read_games(path):
+    ''' Yields the moves of each game of a .pgn file, or of a file with one
+    game per line '''
+    with open(path) as f:
+        for game in (pgn_file_games(f) if path.endswith('.pgn') else list_games(f)):
+            yield game
+
+def read_move(pos, text, black):
+    ''' The sunfish move for a move in algebraic or coordinate notation, or
+    None if it isn't a legal move of pos '''
+    if COORDINATE.match(text):
+        move = sunfish_glue.coordinateToSunfishMove(text, black)
+        return move if move in sunfish_glue.legalSunfishMoves(pos) else None
+    return sunfish_glue.sanToSunfishMove(pos, text, black)
+
+def count_moves(games, plies, counts=None):
+    ''' Counts how many times each move was played in each position, over the
+    first plies moves of the games. Games are cut at the first move that
+    can't be read, which is reported. '''
+    counts = defaultdict(lambda: defaultdict(int)) if counts is None else counts
+    for game in games:
+        pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+        for ply, text in enumerate(game[:plies]):
+            move = read_move(pos, text, ply % 2 == 1)
+            if move is None:
+                print('Skipping the rest of %s after "%s"' % (' '.join(game[:ply]), text), file=sys.stderr)
+                break
+            counts[pos.key][move] += 1
+            pos = pos.move(move)
+    return counts
+
+def write_book(path, counts, min_count=1):
+    ''' Writes the counted moves played at least min_count times '''
+    records = []
+    for key, moves in counts.items():
+        for (i, j), count in moves.items():
+            if count >= min_count:
+                records.append((key, -count, i * 120 + j))
+    records.sort()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records)))
+        for key, count, move in records:
+            f.write(RECORD.pack(key, move, min(-count, 0xffff)))
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query an opening book')
+    sub = parser.add_subparsers(dest='command')
+    build = sub.add_parser('build', help='build a book from PGN or move list files')
+    build.add_argument('book')
+    build.add_argument('games', nargs='+', help='.pgn files, or files with one game per line')
+    build.add_argument('--plies', type=int, default=20, help='moves of each game to keep')
+    build.add_argument('--min-count', type=int, default=1, help='games a move must be played in')
+    probe = sub.add_parser('probe', help='list the book moves after the given moves')
+    probe.add_argument('book')
+    probe.add_argument('moves', nargs='*')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        counts = None
+        for path in args.games:
+            counts = count_moves(read_games(path), args.plies, counts)
+        n = write_book(args.book, counts or {}, args.min_count)
+        print('Wrote %d moves for %d positions to %s' % (n, len(counts or {}), args.book))
+    elif args.command == 'probe':
+        book = Book(args.book)
+        pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+        for ply, text in enumerate(args.moves):
+            pos = pos.move(sunfish_glue.sanToSunfishMove(pos, text, ply % 2 == 1))
+        black = len(args.moves) % 2 == 1
+        for move, weight in book.moves(pos.key):
+            print(sunfish_glue.sunfishToSanMove(pos, move, black), weight)
+        book.close()
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,81 @@
 # -*- coding: utf8 -*-
 
 import db
+import os
+import multiprocessing
+import arduino
+import book
 import time
+import store
+import tablebase
 import voice
 import serial
+import simulator
 import sunfish
 import sunfish_glue
+import sunfish_board
 
-# Initialize the serial port
-ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=0.25)  # open serial port
+# Engine backend used by the computer players. sunfish_board plays the same
+# moves as the plain sunfish module, but searches a lot more nodes per second
+ENGINE = sunfish_board
+
+# Number of worker processes the computer player splits the root moves over,
+# the main process searching the first one meanwhile, so one per core but the
+# main one's. 1 is the plain serial search, as on a single core board.
+ENGINE_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+
+# Whether the computer keeps searching while a human opponent plays, on the
+# position it expects after their reply
+ENGINE_PONDER = True
+
+# Opening book the computer players play from instantly while in book,
+# built with: python book.py build book.bin openings.txt
+BOOK_PATH = 'book.bin'
+openingBook = book.Book(BOOK_PATH) if os.path.exists(BOOK_PATH) else None
+
+# Endgame tables the engine plays simple endgames from perfectly,
+# built with: python tablebase.py build endgames.bin
+TABLEBASE_PATH = 'endgames.bin'
+endgames = tablebase.Tablebase(TABLEBASE_PATH) if os.path.exists(TABLEBASE_PATH) else None
+
+# File the engine keeps its analysis in across games, so that positions met
+# again are answered at once. None disables it.
+STORE_PATH = 'analysis.bin'
+
+# Serial port of the board, or 'virtual' to play on the simulated board of
+# simulator.py, moving at the speed of the real one
+SERIAL_PORT = '/dev/ttyUSB0'
+
+# Whether to ask the board for the binary events protocol, which is shorter on
+# the wire and can't be confused with the debug prints
+SERIAL_BINARY = True
+
+# Phrases and sounds said during the games, rendered when the daemon starts so
+# that they are said at once
+VOICE_PROMPTS = [
+    "Benvenuto, quale modalità vuoi attivare?",
+    "Non è una modalità valida, riprova",
+    "Turno del giocatore bianco",
+    "Turno del giocatore nero",
+    "Non è una mossa valida, riprova",
+]
+VOICE_SOUNDS = ["sounds/ready.mp3"]
+
+# Whether phrases are said by the offline stand-in of the text to speech
+# service, as tones, rather than downloaded from Google
+VOICE_OFFLINE = False
+
+# Speech recognizer of the voice commands, 'google' or 'sphinx' to recognize
+# them locally, without the network
+VOICE_RECOGNIZER = 'google'
+
+# The arduino.SerialLink to the board, opened by the main program once the
+# engine is started, and the arduino.CommandPipeline commands are sent through
+link = None
+pipeline = None
+
+# The arduino.BoardModel of the pieces on the board, kept from the moves sent
+boardModel = None
 
 # Load/initialize the voice replacements database, which is used to
 # fix some misunderstandings of Google Voice
@@ -17,25 +84,11 @@ if replacements is None:
     replacements = []
     db.saveDB('replacements', replacements)
 
-# This method allows to wait for the Arduino firmware to report the ready state
+# This method allows to wait for the Arduino firmware to report the ready state,
+# which may have been reported before it is called
 def waitReady(timeout=15):
     print("[DEBUG] waiting for chessboard to be ready")
-    start = time.time()
-    while True:
-        if (time.time() - start) > timeout:
-            return False
-        line = ser.readline()
-        if line is None:
-            continue
-        if not "[LOG]" in line:
-            continue
-        line = line.replace('\n', '').replace('\r', '')
-        print("[SERIAL] parsing line: " + line)
-        tokens = line.split(' ')
-        if tokens is None or len(tokens) < 2:
-            continue
-        if tokens[1] == 'READY':
-            return True
+    return link.waitFor(('READY',), timeout, after=0) is not None
 
 # This method sends a move to the Arduino, in the form
 #  <piece>, <dx>, <dy>
@@ -44,117 +97,103 @@ def waitReady(timeout=15):
 #  <sx>, <sy>, <dx>, <dy>
 # Both for the input and the returned move, a list/tuple is used
 def sendMove(move, timeout=3):
-    string = "M" + str(move[0]) + str(move[1]) + str(move[2]) + '0'
-    print("[SERIAL] send: \"" + string + "\"")
-    ser.flushInput() # Clear the input buffer
-    ser.write(string + '\n')
-    start = time.time()
-    while True:
-        if (time.time() - start) > timeout:
-            return None
-        line = ser.readline()
-        if line is None:
-            return None
-        if not "[LOG]" in line:
-            continue
-        line = line.replace('\n', '').replace('\r', '')
-        print("[SERIAL] parsing line: " + line)
-        tokens = line.split(' ')
-        if tokens is None or len(tokens) < 2:
-            continue
-        if tokens[1] == 'MP':
-            if len(tokens) != 6:
-                continue
-            boardMove = []
-            boardMove.append(int(tokens[2]))
-            boardMove.append(int(tokens[3]))
-            boardMove.append(int(tokens[4]))
-            boardMove.append(int(tokens[5]))
-            # Check if the move is not valid
-            if any(n < 0 for n in boardMove):
-                # If it is not, the move probably is an elimination
-                # move, so not taken into consideration
-                continue
-            return boardMove
-        elif tokens[1] == 'ERR_WRONG_MOVE':
-            return None
-        elif tokens[1] == 'ERR_DESTINATION_OCCUPIED':
-            return None
-        else:
-            return None
-    return boardMove
+    command = pipeline.submit("M" + str(move[0]) + str(move[1]) + str(move[2]) + '0')
+    try:
+        moves = command.result(timeout)
+    except arduino.CommandError as e:
+        print("[SERIAL] move not made: " + str(e))
+        return None
+    # The moves of the eliminated pieces, if any, come first
+    return list(moves[-1])
 
 # This method is similar to the one above, but instead sends a
 # raw move in the form:
 #  <sx>, <sy>, <dx>, <dy>
-# TODO: catch and return errors
+# and returns its arduino.Command without waiting for it
 def sendRawMove(move):
-    string = "R" + str(move[0]) + str(move[1]) + str(move[2]) + str(move[3])
-    print("[SERIAL] send: \"" + string + "\"")
-    ser.flushInput() # Clear the input buffer
-    ser.write(string + '\n')
+    return pipeline.submit("R" + str(move[0]) + str(move[1]) + str(move[2]) + str(move[3]))
+
+# This method streams a sequence of raw moves to the board, like the ones
+# setting up or resetting the pieces, keeping several of them in flight, and
+# waits for all of them to be carried out
+# Returns the list of the errors reported by the board, or None if a timeout
+# occurred
+def sendRawMoves(moves, timeout=120):
+    commands = [sendRawMove(move) for move in moves]
+    if not pipeline.drain(timeout):
+        return None
+    return [e for c in commands for e in c.errors]
 
 # This method waits for the Arduino to report its move queue empty, meaning
 # that all the requested moves have been carried out
 # Returns False if a timeout occurred, otherwise returns True if the Arduino
 # completed the move within the specified time
 def waitMoveEnd(timeout=30):
-    start = time.time()
-    while True:
-        if (time.time() - start) > timeout:
-            return False
-        line = ser.readline()
-        if line is None:
-            continue
-        if not "[LOG]" in line:
-            continue
-        line = line.replace('\n', '').replace('\r', '')
-        print("[SERIAL] parsing line: " + line)
-        tokens = line.split(' ')
-        if tokens is None or len(tokens) < 2:
-            continue
-        if tokens[1] == 'QE':
-            return True
+    return pipeline.drain(timeout)
 
-# This method reads the board pieces matrix from the Arduino and returns it,
-# already converted/parsed/etc...
+# This method returns the board pieces matrix, as a matrix[x][y], from the
+# model of the board, without asking the Arduino for it
 def getMatrix():
-    ser.flushInput()
-    ser.write('X\n')
-    r = ser.readline()
-    if r is None or r == "":
-        return None
-    else:
-        r = r.replace("[LOG] ", '').replace('\n', '').replace('\r', '').strip()
-        matrix = []
-        for i in range(8):
-            matrix.append([])
-            for j in range(8):
-                matrix[i].append(' ')
-        x = 0
-        y = 7
-        for c in r:
-            # print("c=" + str(c) + ", x=" + str(x) + ", y=" + str(y))
-            matrix[x][y] = c
-            y -= 1
-            if y < 0:
-                y = 7
-                x += 1
-        if x != 8 or y != 7:
-            print("[SERIAL] something went wrong getting matrix")
-            return None
-        else:
-            print("[SERIAL] got matrix")
-            printMatrix(matrix)
-            return matrix
+    return boardModel.matrix()
+
+# This method checks the model of the board against the Arduino when it is
+# time to, or when the Arduino reported an error, and adopts the matrix of the
+# Arduino if they differ. The Arduino must have carried out all its moves.
+# Returns False if the model had drifted from the board
+def checkBoard(timeout=2):
+    if not boardModel.needsCheck():
+        return True
+    try:
+        if boardModel.verify(pipeline, timeout):
+            return True
+    except arduino.CommandError:
+        print("[SERIAL] something went wrong getting matrix")
+        return True
+    print("[SERIAL] the board model had drifted, resynced it")
+    printMatrix(boardModel.matrix())
+    return False
 
-# Quick method to print on screen the matrix read with the method above
+# Quick method to print on screen the matrix returned by the method above
 def printMatrix(m):
     for y in range(8):
         for x in range(8):
             print(m[x][y]),
         print("")
 
+# This method compares the engine position <pos> with the pieces on the board
+# once the move of <player>, from the position <before>, is over. When they
+# differ, the moves explaining the board are looked for, so that a move the
+# board carried out differently, or not at all, doesn't cost the game, and
+# failing that the position is rebuilt from the board.
+# Positions are seen from white, as in the game loop, and the one returned has
+# the opponent of <player> to move
+def reconcileBoard(before, pos, player):
+    board = sunfish_glue.luneburgToSunfishBoard(getMatrix())
+    diff = sunfish_glue.diffSunfishBoards(board, pos.board)
+    if diff == []:
+        return pos
+    print("[SYNC] the board differs from the engine on " + ' '.join(sunfish_glue.squareNames[i] for i in diff))
+    black = player == 'black'
+    if black:
+        before = before.rotate()
+    moves = sunfish_glue.explainSunfishBoard(before, board, black, parity=1)
+    if moves is not None:
+        for move in moves:
+            print("[SYNC] the board played " + sunfish_glue.sunfishToCoordinateMove(move, black))
+            before = before.move(move)
+            black = not black
+        # Back to a position seen from white
+        if black:
+            return before.rotate()
+        return before
+    pos = sunfish_glue.sunfishBoardToPosition(board, pos=pos)
+    if player == 'white':
+        fen = sunfish_glue.sunfishPositionToFen(pos.rotate(), True)
+    else:
+        fen = sunfish_glue.sunfishPositionToFen(pos)
+    print("[SYNC] no moves explain the board, rebuilt the position " + fen)
+    return pos
+
 # This method uses the voice replacements database (loaded at the beginning)
 # to fix a string caught by Google Voice Recognition (through the custom voice.py
 # library)
@@ -260,15 +299,16 @@ def askMove(player):
 # <player_type> is either 'p' (human) or 'c' (computer)
 # <pos> is a sunfish.Position object representing the game state
 # <searcher> is a sunfish.Searcher object associated with <pos>
+# <ponder> tells the computer to think on the opponent's reply after moving
 # Returns:
 #  <move>, <pos>
 # where <move> is the move either in the form
 #  <piece>, <dx>, <dy>
-# OR
+# OR a list of raw moves in the form
 #  <sx>, <sy>, <dx>, <dy>
-# based on the player_type
+# the king's and the rook's when castling, based on the player_type
 # while the returned <pos> is the updated position after the move
-def getMove(player, player_type, pos=None, searcher=None):
+def getMove(player, player_type, pos=None, searcher=None, ponder=False):
     if player_type == 'p':
         return askMove(player), pos
     elif player_type == 'c':
@@ -278,47 +318,81 @@ def getMove(player, player_type, pos=None, searcher=None):
             pos = pos.rotate()
 
         sunfish.print_pos(pos)
-        move, score = searcher.search(pos, secs=2)
+        move = openingBook.choose(pos) if openingBook is not None else None
+        if move is not None:
+            print("[AUTOPLAY] playing a book move")
+        else:
+            move, score = searcher.search(pos, secs=2)
+
+        # The king's move when castling, the rook's move following it
+        moves = [move]
+        if pos.board[move[0]] == 'K' and abs(move[0] - move[1]) == 2:
+            moves.append((sunfish.A1 if move[1] < move[0] else sunfish.H1, (move[0] + move[1]) // 2))
 
         pos = pos.move(move)
+        if ponder:
+            searcher.ponder(pos)
         if player == 'white':
             pos = pos.rotate()
 
         if player == 'black':
-            lmove = sunfish_glue.sunfishToLuneburgRotatedMove(move)
+            lmoves = [sunfish_glue.sunfishToLuneburgRotatedMove(m) for m in moves]
         else:
-            lmove = sunfish_glue.sunfishToLuneburgMove(move)
-        return lmove, pos
+            lmoves = [sunfish_glue.sunfishToLuneburgMove(m) for m in moves]
+        return lmoves, pos
     else:
         return None, pos
 
+# This method returns the square and the piece for the board model to promote
+# the pawn <piece> to when the raw move <move> takes it to the last rank, in the
+# form
+#  <x>, <y>, <piece>
+# or None for other moves. Sunfish always promotes to a queen.
+def promotionOf(piece, move):
+    if piece == 'P' and move[3] == 7:
+        return move[2], move[3], 'G'
+    if piece == 'p' and move[3] == 0:
+        return move[2], move[3], 'g'
+    return None
+
 # This method is used simply to reduce the code in the main loop
 # It simply gets the move for the specified player, sends it to the Arduino
 # and eventually updates the sunfish.Position <pos> with the Arduino parsed move.
 # All of this is done while checking for errors.
-def doPlayer(player, player_type, pos=None, searcher=None):
+def doPlayer(player, player_type, pos=None, searcher=None, ponder=False):
     print("[doplayer] pos=" + str(pos) + " searcher=" + str(searcher))
+    before = pos
     while True:
-        move, npos = getMove(player, player_type, pos, searcher)
+        move, npos = getMove(player, player_type, pos, searcher, ponder)
         pos = npos
         if len(move) == 3:
             res = sendMove(move)
             if res is None:
                 continue
             print("[DEBUG] arduino parsed move to " + str(res))
+            promotion = promotionOf(move[0], res)
             if pos is not None:
                 smove = sunfish_glue.luneburgToSunfishMove(res)
                 pos = pos.move(smove).rotate()
                 sunfish.print_pos(pos)
-        elif len(move) == 4:
-            sendRawMove(move)
+        else:
+            promotion = None
+            for raw in move:
+                promotion = promotion or promotionOf(boardModel.get(raw[0], raw[1]), raw)
+                sendRawMove(raw)
         waitMoveEnd()
+        # Told once the move is over, the captured piece being out of the way
+        if promotion is not None:
+            boardModel.promote(*promotion)
+        checkBoard()
+        if pos is not None:
+            pos = reconcileBoard(before, pos, player)
         print("[DEBUG] move finished")
         if pos is not None: sunfish.print_pos(pos)
         return pos
 
 # Main game method, containing the game loop
-def game(mode):
+def game(mode, searcher):
     white_type = 'p'
     black_type = 'p'
 
@@ -330,20 +404,44 @@ def game(mode):
 
     if mode != 'p_vs_p':
         pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
-        searcher = sunfish.Searcher()
     else:
         pos = None
         searcher = None
 
+    # Pondering only pays off against a human, who takes a while to reply
+    ponder = ENGINE_PONDER and mode == 'p_vs_c'
+
     while True:
         pos = doPlayer('white', white_type, pos=pos, searcher=searcher)
-        pos = doPlayer('black', black_type, pos=pos, searcher=searcher)
+        pos = doPlayer('black', black_type, pos=pos, searcher=searcher, ponder=ponder)
 
 # Main program
 if __name__ == "__main__":
-    voice.init() # Init voice engine (speech recognition and TTS)
+    # Start the engine before opening the analysis store and the serial port,
+    # so that the processes of a parallel search don't inherit them
+    searcher = ENGINE.Searcher(workers=ENGINE_WORKERS, tablebase=endgames)
+    if STORE_PATH is not None:
+        searcher.store = store.AnalysisStore(STORE_PATH)
+
+    # Initialize the serial port, read from in the background from now on
+    if SERIAL_PORT == 'virtual':
+        port = simulator.VirtualBoard()
+    else:
+        port = serial.Serial(SERIAL_PORT, 115200, timeout=0.25)
+    link = arduino.SerialLink(port)
+    pipeline = arduino.CommandPipeline(link)
+    boardModel = arduino.BoardModel(link)
+
+    voice.init(VOICE_PROMPTS, VOICE_SOUNDS, offline=VOICE_OFFLINE, recognizer=VOICE_RECOGNIZER) # Init voice engine (speech recognition and TTS)
 
     waitReady() # Wait for the firmware to report ready state
+    if SERIAL_BINARY:
+        if link.useBinaryProtocol():
+            print("[SERIAL] using the binary protocol")
+            # Firmware speaking it can also checksum its matrix
+            boardModel.useChecksum = True
+        else:
+            print("[SERIAL] the board only speaks the text protocol")
 
     # Ask for the playing mode
     voice.talk("Benvenuto, quale modalità vuoi attivare?")
@@ -366,7 +464,12 @@ if __name__ == "__main__":
             voice.play("sounds/ready.mp3")
 
     # Enter the game in the specified move
-    game(mode)
-
-    # Close the serial at the end
-    ser.close()
+    try:
+        game(mode, searcher)
+    finally:
+        # Stop the search processes, save the analysis and close the serial
+        searcher.close()
+        if searcher.store is not None:
+            searcher.store.close()
+        link.close()
+        voice.close()
@@ -0,0 +1,289 @@
+# Voice input service. A single capture stream is kept open and read by a
+# background thread, which tells speech from silence by its energy and cuts the
+# audio into utterances. Each utterance is handed through a queue to a pool of
+# recognizer threads as soon as it ends, so that its text is usually known by
+# the time it is asked for, and recognitions of consecutive utterances overlap.
+# Texts are handed out in the order the utterances were spoken.
+#
+# Sources:
+#  - MicrophoneSource, the microphone through speech_recognition
+#  - PcmSource, a stand-in playing the audio it is given, silence otherwise,
+#    for tests and the simulator
+# Recognizers:
+#  - GoogleRecognizer, Google Speech Recognition as voice.py always used it
+#  - SphinxRecognizer, CMU Sphinx running locally, which needs pocketsphinx
+#    and the models of the language
+#  - ScriptedRecognizer, answering given texts, for tests
+
+import time
+import array
+import math
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# The root mean square of 16 bits samples
+def rms(chunk):
+    samples = array.array('h', chunk)
+    if not samples:
+        return 0
+    return math.sqrt(sum(s * s for s in samples) / float(len(samples)))
+
+# The microphone, opened once and read until closed
+class MicrophoneSource:
+    def __init__(self, device=None, sampleRate=16000, chunkSize=1024):
+        self.device = device
+        self.sampleRate = sampleRate
+        self.chunkSize = chunkSize
+        self.microphone = None
+
+    # This method opens the source, returning its sample rate and width
+    def open(self):
+        import speech_recognition as sr
+        self.microphone = sr.Microphone(self.device, self.sampleRate, self.chunkSize)
+        self.microphone.__enter__()
+        return self.microphone.SAMPLE_RATE, self.microphone.SAMPLE_WIDTH
+
+    def read(self):
+        return self.microphone.stream.read(self.microphone.CHUNK)
+
+    def close(self):
+        if self.microphone is not None:
+            self.microphone.__exit__(None, None, None)
+            self.microphone = None
+
+# A source playing the audio given to say(), and silence otherwise, in chunks
+# of <chunkSize> samples at the pace of a microphone times <timeScale>
+class PcmSource:
+    def __init__(self, sampleRate=16000, chunkSize=1024, timeScale=1.0):
+        self.sampleRate = sampleRate
+        self.chunkBytes = chunkSize * 2
+        self.timeScale = timeScale
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def open(self):
+        return self.sampleRate, 2
+
+    def say(self, pcm):
+        with self.lock:
+            self.buffer += pcm
+
+    def read(self):
+        time.sleep(self.chunkBytes / 2.0 / self.sampleRate * self.timeScale)
+        with self.lock:
+            chunk = self.buffer[:self.chunkBytes]
+            self.buffer = self.buffer[self.chunkBytes:]
+        return chunk + b'\0' * (self.chunkBytes - len(chunk))
+
+    def close(self):
+        pass
+
+# Speech cut out of the capture stream, in the order it was heard. <text> is
+# set, and <done> too, once it has been recognized.
+class Utterance:
+    def __init__(self, number, pcm, sampleRate, sampleWidth):
+        self.number = number
+        self.pcm = pcm
+        self.sampleRate = sampleRate
+        self.sampleWidth = sampleWidth
+        self.text = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def seconds(self):
+        return float(len(self.pcm)) / (self.sampleRate * self.sampleWidth)
+
+class GoogleRecognizer:
+    def __init__(self, language='it-IT'):
+        import speech_recognition as sr
+        self.sr = sr
+        self.language = language
+        self.recognizer = sr.Recognizer()
+
+    # This method returns the text of <utterance>, or None if it couldn't be
+    # understood
+    def recognize(self, utterance):
+        audio = self.sr.AudioData(utterance.pcm, utterance.sampleRate, utterance.sampleWidth)
+        try:
+            return self.recognizer.recognize_google(audio, language=self.language)
+        except self.sr.UnknownValueError:
+            print("Google Speech Recognition could not understand audio")
+            return None
+        except self.sr.RequestError as e:
+            print("Could not request results from Google Speech Recognition service; {0}".format(e))
+            return None
+
+class SphinxRecognizer:
+    def __init__(self, language='it-IT'):
+        import speech_recognition as sr
+        self.sr = sr
+        self.language = language
+        self.recognizer = sr.Recognizer()
+
+    def recognize(self, utterance):
+        audio = self.sr.AudioData(utterance.pcm, utterance.sampleRate, utterance.sampleWidth)
+        try:
+            return self.recognizer.recognize_sphinx(audio, language=self.language)
+        except self.sr.UnknownValueError:
+            print("Sphinx could not understand audio")
+            return None
+        except self.sr.RequestError as e:
+            print("Sphinx error; {0}".format(e))
+            return None
+
+# A recognizer answering the texts of <answers> to the utterances in the order
+# they were heard, the last one over and over, after <delay> seconds
+class ScriptedRecognizer:
+    def __init__(self, answers, delay=0):
+        self.answers = answers
+        self.delay = delay
+
+    def recognize(self, utterance):
+        time.sleep(self.delay)
+        return self.answers[min(utterance.number, len(self.answers) - 1)]
+
+# The voice input service, hearing <source> and recognizing what is said with
+# <recognizer> on <workers> threads.
+# Speech starts when the energy of the audio rises above the threshold, which
+# follows the ambient noise, and ends after <pauseSecs> below it. Utterances of
+# less than <minPhraseSecs> of speech are taken for noise, and utterances are
+# cut after <maxPhraseSecs>. <preRollSecs> of audio before the speech are kept,
+# not to lose the start of the first word.
+class Listener:
+    def __init__(self, source, recognizer, workers=2, pauseSecs=0.8, minPhraseSecs=0.3,
+                 maxPhraseSecs=10, preRollSecs=0.3, calibrateSecs=1.0,
+                 energyRatio=1.5, minEnergy=300):
+        self.source = source
+        self.recognizer = recognizer
+        self.pauseSecs = pauseSecs
+        self.minPhraseSecs = minPhraseSecs
+        self.maxPhraseSecs = maxPhraseSecs
+        self.preRollSecs = preRollSecs
+        self.calibrateSecs = calibrateSecs
+        self.energyRatio = energyRatio
+        self.minEnergy = minEnergy
+        self.threshold = None
+        # Utterances waiting for a recognizer, and waiting to be listened to
+        self.pending = queue.Queue()
+        self.heard = queue.Queue()
+        self.count = 0
+        self.muted = False
+        self.stopped = False
+        self.workers = [threading.Thread(target=self.recognizeLoop) for _ in range(workers)]
+        self.capture = threading.Thread(target=self.captureLoop)
+
+    def start(self):
+        for thread in self.workers + [self.capture]:
+            thread.daemon = True
+            thread.start()
+
+    def recognizeLoop(self):
+        while True:
+            utterance = self.pending.get()
+            if utterance is None:
+                return
+            if not utterance.cancelled:
+                try:
+                    utterance.text = self.recognizer.recognize(utterance)
+                except Exception as e:
+                    print("[VOICE] recognition failed: " + str(e))
+            utterance.done.set()
+
+    def captureLoop(self):
+        sampleRate, sampleWidth = self.source.open()
+        try:
+            self.hear(sampleRate, sampleWidth)
+        finally:
+            self.source.close()
+
+    def hear(self, sampleRate, sampleWidth):
+        # The ambient noise first
+        energies = []
+        calibrated = 0.
+        while calibrated < self.calibrateSecs and not self.stopped:
+            chunk = self.source.read()
+            energies.append(rms(chunk))
+            calibrated += float(len(chunk)) / (sampleRate * sampleWidth)
+        if energies:
+            self.threshold = max(self.minEnergy, self.energyRatio * sum(energies) / len(energies))
+
+        preRoll = deque()
+        speech = None
+        while not self.stopped:
+            chunk = self.source.read()
+            secs = float(len(chunk)) / (sampleRate * sampleWidth)
+            if self.muted:
+                speech = None
+                preRoll.clear()
+                continue
+            energy = rms(chunk)
+            if speech is None:
+                if energy > self.threshold:
+                    speech = list(preRoll) + [chunk]
+                    spoken, silent, length = secs, 0., secs * len(speech)
+                    preRoll.clear()
+                    continue
+                preRoll.append(chunk)
+                if len(preRoll) * secs > self.preRollSecs:
+                    preRoll.popleft()
+                # Following the ambient noise, a second to get halfway
+                damping = 0.5 ** secs
+                self.threshold = max(self.minEnergy, damping * self.threshold +
+                                     (1 - damping) * self.energyRatio * energy)
+                continue
+            speech.append(chunk)
+            length += secs
+            if energy > self.threshold:
+                spoken += secs
+                silent = 0.
+            else:
+                silent += secs
+            if silent >= self.pauseSecs or length >= self.maxPhraseSecs:
+                if spoken >= self.minPhraseSecs:
+                    utterance = Utterance(self.count, b''.join(speech), sampleRate, sampleWidth)
+                    self.count += 1
+                    self.pending.put(utterance)
+                    self.heard.put(utterance)
+                speech = None
+
+    # This method returns the text of the next utterance, as soon as it is
+    # recognized, or None if it couldn't be understood or if nothing was said
+    # within <timeout> seconds
+    def listen(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            utterance = self.heard.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if deadline is None:
+            utterance.done.wait()
+        else:
+            utterance.done.wait(max(0, deadline - time.time()))
+        return utterance.text
+
+    # This method forgets what was heard and not listened to yet
+    def flush(self):
+        while True:
+            try:
+                self.heard.get_nowait().cancelled = True
+            except queue.Empty:
+                return
+
+    # This method stops hearing until unmute(), like while the board speaks,
+    # not to hear itself. What was heard before is forgotten on unmute().
+    def mute(self):
+        self.muted = True
+
+    def unmute(self):
+        self.flush()
+        self.muted = False
+
+    def close(self):
+        self.stopped = True
+        for thread in self.workers:
+            self.pending.put(None)
+        self.capture.join()
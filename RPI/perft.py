@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Perft, the count of the legal move sequences of a given length, to check the
+# move generators against known counts and to time them.
+#
+#   python perft.py --depth 4
+#   python perft.py --fen "<fen>" --depth 3 --divide --engine sunfish_board
+#   python perft.py --check
+#
+# Sunfish only promotes to queens, so the counts of positions where pawns can
+# promote within the depth are lower than the usual ones, and the positions of
+# --check are chosen so that this doesn't happen.
+
+from __future__ import print_function
+import sys, time, argparse
+import sunfish
+import sunfish_board
+import sunfish_glue
+
+INITIAL = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Positions with their known counts, by depth starting from 1
+KNOWN = [
+    (INITIAL, [20, 400, 8902, 197281]),
+    ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+        [48, 2039, 97862]),
+    ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238]),
+]
+
+def perft(pos, depth):
+    ''' Leaves of the tree of legal moves of the Position pos '''
+    nodes = 0
+    for move in pos.gen_moves():
+        child = pos.move(move)
+        # Moves leaving our king to be captured are illegal, this also covers
+        # castling out of or through check thanks to the king passant square.
+        if child.can_capture_king():
+            continue
+        nodes += perft(child, depth-1) if depth > 1 else 1
+    return nodes
+
+def perft_board(board, depth):
+    ''' Same as perft, with make/unmake on a sunfish_board.Board '''
+    nodes = 0
+    for move in board.gen_moves():
+        board.make(move)
+        if not board.can_capture_king():
+            nodes += perft_board(board, depth-1) if depth > 1 else 1
+        board.unmake()
+    return nodes
+
+def divide(pos, depth, engine):
+    ''' Perft of each legal move of pos, to depth-1 '''
+    counts = []
+    for move in pos.gen_moves():
+        child = pos.move(move)
+        if child.can_capture_king():
+            continue
+        counts.append((move, run(child, depth-1, engine) if depth > 1 else 1))
+    return counts
+
+def run(pos, depth, engine):
+    if depth == 0:
+        return 1
+    if engine == 'sunfish_board':
+        return perft_board(sunfish_board.Board(pos), depth)
+    return perft(pos, depth)
+
+def check(engine):
+    ''' Compares the counts of the KNOWN positions, returning whether all match '''
+    ok = True
+    for fen, counts in KNOWN:
+        pos = sunfish_glue.fenToSunfishPosition(fen)
+        for depth, expected in enumerate(counts, 1):
+            start = time.time()
+            nodes = run(pos, depth, engine)
+            secs = time.time() - start
+            status = 'ok' if nodes == expected else 'FAIL (expected %d)' % expected
+            ok = ok and nodes == expected
+            print('%s depth %d: %d nodes, %.2fs, %d nps %s' % (
+                fen, depth, nodes, secs, nodes / secs if secs else 0, status))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the move sequences of a position')
+    parser.add_argument('--fen', default=INITIAL)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--engine', default='sunfish', choices=('sunfish', 'sunfish_board'))
+    parser.add_argument('--divide', action='store_true', help='print the count of each move')
+    parser.add_argument('--check', action='store_true', help='compare with known counts')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.engine) else 1)
+
+    pos = sunfish_glue.fenToSunfishPosition(args.fen)
+    black = args.fen.split()[1] == 'b'
+    start = time.time()
+    if args.divide:
+        counts = divide(pos, args.depth, args.engine)
+        for move, count in sorted(counts, key=lambda mc: sunfish_glue.sunfishToCoordinateMove(mc[0], black)):
+            print('%s: %d' % (sunfish_glue.sunfishToCoordinateMove(move, black), count))
+        nodes = sum(count for _, count in counts)
+    else:
+        nodes = run(pos, args.depth, args.engine)
+    secs = time.time() - start
+    print('Nodes: %d' % nodes)
+    print('Time: %.3fs' % secs)
+    print('NPS: %d' % (nodes / secs if secs else 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+# -*- coding: utf8 -*-
+
+# Virtual chessboard, standing in for the Arduino and its serial port so the
+# host can be run and measured without the hardware. VirtualBoard has the
+# read/write/close methods and in_waiting of serial.Serial and behaves like the firmware:
+# it understands the M, R, X, C and B commands, keeps the same matrix, plans the
+# same magnet movements for each piece move and sends the same events, in
+# text or binary frames. Movements take the time the steppers would, from the
+# speeds of Board.cpp, multiplied by <timeScale>, so 0 runs as fast as the host
+# can keep up.
+#
+# Run directly, it plays random games on a virtual board through the
+# arduino.SerialLink and arduino.CommandPipeline of the daemon, and reports the
+# latency of the moves:
+#
+#   python simulator.py --games 1000 --time-scale 0
+
+from __future__ import print_function
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import arduino
+import sunfish
+import sunfish_glue
+
+# Steps of a cell, and speeds in steps per second with the magnet on and off,
+# from queueMovement and handle in Board.cpp
+STEPS_PER_CELL = 200
+MAGNET_SPEED = 100
+MOVING_SPEED = 300
+
+# Position of the magnet when the limit switches are hit, from handle
+HOME_X = -430
+HOME_Y = 0
+
+class VirtualBoard:
+    def __init__(self, timeScale=1.0, timeout=0.25, debug=True):
+        self.timeScale = timeScale
+        self.timeout = timeout
+        # Whether to send the debug prints of the firmware
+        self.debug = debug
+        self.output = queue.Queue()
+        # Bytes taken from <output> and not read yet
+        self.outputBuffer = b''
+        self.inputBuffer = b''
+        self.cond = threading.Condition()
+        self.closed = False
+        # Bytes sent to the host, to measure the traffic
+        self.bytesSent = 0
+        self.reboot()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    # This method resets the board as the reset button would, putting the
+    # pieces back in their initial position
+    def reboot(self):
+        with self.cond:
+            self.matrix = [[' '] * 12 for y in range(8)]
+            self.resetMatrix()
+            self.pieceMoves = deque()
+            self.binary = False
+            self.currentX = 0
+            self.currentY = 0
+            self.println("Going home...")
+            self.println("Ready for commands")
+            self.emit(arduino.MSG_READY, b'', "READY")
+
+    def resetMatrix(self):
+        # From the h file to the a file, as x goes
+        firstRow = "TCARGACT"
+        for x in range(8):
+            self.setMat(x, 0, firstRow[x])
+            self.setMat(x, 1, 'P')
+            for y in range(2, 6):
+                self.setMat(x, y, ' ')
+            self.setMat(x, 6, 'p')
+            self.setMat(x, 7, firstRow[x].lower())
+
+    # MAT in Common.h, x going from -2 to 9 to include the graveyards
+    def mat(self, x, y):
+        return self.matrix[y][x + 2]
+
+    def setMat(self, x, y, c):
+        self.matrix[y][x + 2] = c
+
+    ###########################################################################
+    # Serial port
+    ###########################################################################
+
+    def send(self, data):
+        self.bytesSent += len(data)
+        self.output.put(data)
+
+    def println(self, text):
+        if self.debug:
+            self.send((text + '\r\n').encode('ascii'))
+
+    # This method sends an event, as a frame or a [LOG] line like Protocol.cpp
+    def emit(self, msgType, payload, text):
+        if self.binary:
+            self.send(arduino.encodeFrame(msgType, payload))
+        else:
+            self.send(("[LOG] " + text + '\r\n').encode('ascii'))
+
+    @property
+    def in_waiting(self):
+        while True:
+            try:
+                self.outputBuffer += self.output.get_nowait()
+            except queue.Empty:
+                return len(self.outputBuffer)
+
+    def read(self, size=1):
+        if not self.outputBuffer:
+            try:
+                self.outputBuffer = self.output.get(timeout=self.timeout)
+            except queue.Empty:
+                return b''
+        data = self.outputBuffer[:size]
+        self.outputBuffer = self.outputBuffer[size:]
+        return data
+
+    def write(self, data):
+        self.inputBuffer += data
+        while b'\n' in self.inputBuffer:
+            line, self.inputBuffer = self.inputBuffer.split(b'\n', 1)
+            with self.cond:
+                self.parseCommand(line.decode('ascii'))
+                self.cond.notify_all()
+        return len(data)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        # Wake up a reader waiting for data
+        self.output.put(b'')
+
+    ###########################################################################
+    # Commands, as in ChessBoard.ino
+    ###########################################################################
+
+    def parseCommand(self, command):
+        if len(command) < 1:
+            return
+        if command[0] == 'M':
+            if len(command) != 5:
+                return
+            if self.queueMovePieceByName(command[1], int(command[2]), int(command[3])):
+                self.emit(arduino.MSG_OK, b'', "OK")
+            else:
+                self.emit(arduino.MSG_ERR, b'\x01', "ERR_WRONG_MOVE")
+        elif command[0] == 'R':
+            if len(command) != 5:
+                return
+            sx, sy, dx, dy = [int(c) for c in command[1:]]
+            self.queueMovePiece(sx, sy, dx, dy, True)
+        elif command[0] == 'X':
+            cells = ''.join(self.mat(x, y) for x in range(8) for y in range(8))
+            self.emit(arduino.MSG_MATRIX, cells.encode('ascii'), cells)
+        elif command[0] == 'C':
+            cells = ''.join(self.mat(x, y) for x in range(8) for y in range(8))
+            crc = arduino.crc8(bytearray(cells.encode('ascii')))
+            self.emit(arduino.MSG_CHECKSUM, bytes(bytearray([crc])), "CS %d" % crc)
+        elif command[0] == 'B':
+            if len(command) != 2:
+                return
+            version = int(command[1])
+            if version in (0, arduino.PROTOCOL_VERSION):
+                self.binary = version == arduino.PROTOCOL_VERSION
+                self.emit(arduino.MSG_PROTOCOL, bytes(bytearray([version])), "PROTOCOL 0")
+            else:
+                self.emit(arduino.MSG_ERR, b'\x04', "ERR_PROTOCOL")
+
+    # queueMovePiece(int sx, int sy, int dx, int dy, bool eliminate) of
+    # Board.cpp
+    def queueMovePiece(self, sx, sy, dx, dy, eliminate=False):
+        self.emit(arduino.MSG_MP, arduino.MP_PAYLOAD.pack(sx, sy, dx, dy),
+                  "MP %d %d %d %d" % (sx, sy, dx, dy))
+        if eliminate:
+            target = self.mat(dx, dy)
+            if target != ' ':
+                graveyard = self.getGraveyard(target.isupper())
+                if graveyard is not None:
+                    self.pieceMoves.append((dx, dy) + graveyard)
+        self.pieceMoves.append((sx, sy, dx, dy))
+
+    # queueMovePiece(char p, int dx, int dy, Indication i) of Board.cpp,
+    # looking for the piece the same way, quirks included
+    def queueMovePieceByName(self, p, dx, dy):
+        search = p.lower()
+        target = self.mat(dx, dy)
+        elimination = target != ' '
+        if p.isupper() and not target.islower():
+            elimination = False
+        if p.islower() and not target.isupper():
+            elimination = False
+        if target != ' ' and not elimination:
+            return False
+        found = []
+        for x in range(8):
+            for y in range(8):
+                if self.mat(x, y) != p:
+                    continue
+                if search == 'p':
+                    if p.isupper():
+                        forward = dy - y
+                    else:
+                        forward = y - dy
+                    if elimination:
+                        ok = abs(x - dx) == 1 and forward == 1
+                    else:
+                        ok = x == dx and 0 < forward <= 2
+                        if ok and forward == 2 and self.mat(x, (y + dy) // 2) != ' ':
+                            ok = False
+                    if ok:
+                        found.append((x, y))
+                if search in 'tg' and ((x != dx and y == dy) or (x == dx and y != dy)):
+                    # The firmware doesn't check the rook paths for obstacles
+                    found.append((x, y))
+                if search in 'ag' and abs(x - dx) == abs(y - dy):
+                    walkX = 1 if dx > x else -1
+                    walkY = 1 if dy > y else -1
+                    if all(self.mat(x + i * walkX, y + i * walkY) == ' ' for i in range(1, abs(dx - x))):
+                        found.append((x, y))
+                if search == 'r' and (abs(x - dx) == 1 or abs(y - dy) == 1):
+                    found.append((x, y))
+                if search == 'c' and sorted((abs(x - dx), abs(y - dy))) == [1, 2]:
+                    found.append((x, y))
+        if len(found) != 1:
+            return False
+        if elimination:
+            graveyard = self.getGraveyard(target.isupper())
+            if graveyard is not None:
+                self.queueMovePiece(dx, dy, graveyard[0], graveyard[1])
+        self.queueMovePiece(found[0][0], found[0][1], dx, dy)
+        return True
+
+    # getGraveyard of Board.cpp: the last free cell of the two graveyard
+    # columns of the player, white ones being on the right
+    def getGraveyard(self, white):
+        startX = -2 + (10 if white else 0)
+        cell = None
+        for y in range(8):
+            for x in range(startX, startX + 2):
+                if self.mat(x, y) == ' ':
+                    cell = (x, y)
+                    break
+        return cell
+
+    ###########################################################################
+    # Motion, as in movePiece and handle of Board.cpp
+    ###########################################################################
+
+    # This method returns the movements of a piece move, as (relative, x, y,
+    # magnet) in steps, and updates the matrix
+    def movePiece(self, sx, sy, dx, dy):
+        if self.mat(sx, sy) == ' ':
+            self.emit(arduino.MSG_ERR, b'\x02', "ERR_LOCATION_EMPTY")
+            return []
+        if self.mat(dx, dy) != ' ':
+            self.emit(arduino.MSG_ERR, b'\x03', "ERR_DESTINATION_OCCUPIED")
+            return []
+        movements = []
+        def movement(x, y, magnet, relative=True):
+            movements.append((relative, int(x * STEPS_PER_CELL), int(y * STEPS_PER_CELL), magnet))
+        # Go under the piece to move
+        movement(sx, sy, False, relative=False)
+        diffX = dx - sx
+        diffY = dy - sy
+        walkX = (diffX > 0) - (diffX < 0)
+        walkY = (diffY > 0) - (diffY < 0)
+        doDiagonal = (abs(diffX) == abs(diffY) and
+                      all(self.mat(sx + i * walkX, sy + i * walkY) == ' ' for i in range(1, abs(diffX) + 1)))
+        if doDiagonal:
+            movement(diffX, diffY, True)
+            movement(0, 0, False)
+        else:
+            dodgeY = walkY != 0 and any(self.mat(sx, y) != ' ' for y in range(sy + walkY, dy + walkY, walkY))
+            dodgeX = diffY != 0 and walkX != 0 and any(self.mat(x, dy) != ' ' for x in range(sx, dx, walkX))
+            dodgeXval = 0.5 if dodgeX else 0
+            dodgeYval = 0.5 if dodgeY else 0
+            movement(dodgeYval, dodgeXval, True)
+            movement(0, diffY, True)
+            if diffX > 0 and dodgeY:
+                movement(diffX - 1, 0, True)
+                movement(dodgeYval, -dodgeXval, True)
+            else:
+                movement(diffX, 0, True)
+                movement(-dodgeYval, -dodgeXval, True)
+            movement(0, 0, False)
+        # Auto-homing
+        if dx <= 2 and dy <= 2:
+            movement(-100, -100, False)
+            movement(0, 0, False, relative=False)
+        self.setMat(dx, dy, self.mat(sx, sy))
+        self.setMat(sx, sy, ' ')
+        return movements
+
+    # This method moves the magnet, returning the seconds it takes
+    def execute(self, relative, x, y, magnet):
+        moveX, moveY = (x, y) if relative else (x - self.currentX, y - self.currentY)
+        # The limit switches stop the moves towards home
+        moveX = max(moveX, HOME_X - self.currentX)
+        moveY = max(moveY, HOME_Y - self.currentY)
+        self.currentX += moveX
+        self.currentY += moveY
+        return max(abs(moveX), abs(moveY)) / float(MAGNET_SPEED if magnet else MOVING_SPEED)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pieceMoves and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                movements = self.movePiece(*self.pieceMoves.popleft())
+            for n, m in enumerate(movements):
+                with self.cond:
+                    secs = self.execute(*m)
+                    if self.debug:
+                        self.println("Pop: %d, %d (current x=%d, y=%d)" % (m[1], m[2], self.currentX, self.currentY))
+                    # The queue empty event comes when the last movement starts
+                    if n == len(movements) - 1 and not self.pieceMoves:
+                        self.emit(arduino.MSG_QE, b'', "QE")
+                if self.timeScale > 0:
+                    time.sleep(secs * self.timeScale)
+
+###############################################################################
+# Throughput test
+###############################################################################
+
+# This function returns the raw moves of the board for a sunfish move, the
+# rook one included for castling
+def rawMoves(pos, move, black):
+    toLuneburg = sunfish_glue.sunfishToLuneburgRotatedMove if black else sunfish_glue.sunfishToLuneburgMove
+    moves = [toLuneburg(move)]
+    i, j = move
+    if pos.board[i] == 'K' and abs(i - j) == 2:
+        moves.append(toLuneburg((sunfish.A1 if j < i else sunfish.H1, (i + j) // 2)))
+    return moves
+
+# This function plays random games on <board> through <link> and <pipeline>,
+# returning the seconds each move took from being sent to being carried out,
+# the errors reported by the board and the number of times <model> had
+# drifted from it when checked
+def playGames(board, link, pipeline, model, games, maxPlies, binary, rnd, timeout=60):
+    latencies = []
+    errors = []
+    drifts = 0
+    for game in range(games):
+        after = link.seq
+        board.reboot()
+        if link.waitFor(('READY',), timeout, after) is None:
+            raise arduino.CommandTimeout("the board didn't restart")
+        if binary and not link.useBinaryProtocol():
+            raise arduino.CommandError("the board refused the binary protocol")
+        model.useChecksum = binary
+        pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+        for ply in range(maxPlies):
+            # En passant captures take the pawn off a square the raw moves
+            # don't tell the board about
+            moves = [m for m in sunfish_glue.legalSunfishMoves(pos)
+                     if not (pos.board[m[0]] == 'P' and m[1] == pos.ep)]
+            if not moves:
+                break
+            move = rnd.choice(moves)
+            start = time.time()
+            commands = [pipeline.submit("R%d%d%d%d" % m, timeout) for m in rawMoves(pos, move, ply % 2 == 1)]
+            if not pipeline.drain(timeout):
+                raise arduino.CommandTimeout("move %d of game %d not done" % (ply + 1, game + 1))
+            latencies.append(time.time() - start)
+            errors += [e for c in commands for e in c.errors]
+            if model.needsCheck() and not model.verify(pipeline, timeout):
+                drifts += 1
+            pos = pos.move(move)
+    return latencies, errors, drifts
+
+def main():
+    parser = argparse.ArgumentParser(description='Play random games on a virtual board')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--plies', type=int, default=60, help='moves of each game')
+    parser.add_argument('--time-scale', type=float, default=0., help='1 for the speed of the real board')
+    parser.add_argument('--text', action='store_true', help='use the text protocol')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verify-interval', type=int, default=20, help='moves between checks of the board model')
+    args = parser.parse_args()
+
+    board = VirtualBoard(args.time_scale, debug=False)
+    link = arduino.SerialLink(board, verbose=False)
+    pipeline = arduino.CommandPipeline(link)
+    model = arduino.BoardModel(link, args.verify_interval)
+    start = time.time()
+    try:
+        latencies, errors, drifts = playGames(board, link, pipeline, model, args.games, args.plies,
+                                              not args.text, random.Random(args.seed))
+    finally:
+        link.close()
+    elapsed = time.time() - start
+    latencies.sort()
+    print("%d moves in %.2fs, %.0f moves/s, %d bytes from the board" % (
+        len(latencies), elapsed, len(latencies) / elapsed, board.bytesSent), file=sys.stderr)
+    if latencies:
+        print("latency: mean %.2fms, median %.2fms, 95%% %.2fms, max %.2fms" % (
+            1000 * sum(latencies) / len(latencies), 1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * .95)], 1000 * latencies[-1]), file=sys.stderr)
+    if errors:
+        print("%d errors: %s" % (len(errors), ", ".join(sorted(set(errors)))), file=sys.stderr)
+    if drifts:
+        print("the board model drifted %d times" % drifts, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
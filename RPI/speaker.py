@@ -0,0 +1,267 @@
+# Voice output service. Phrases are rendered to PCM audio by a text to speech
+# backend, kept decoded in memory, and played through a single player process
+# reading from a pipe, so that once a phrase was rendered saying it costs
+# neither a download, nor a decode, nor a new process.
+#
+# The fixed prompts are rendered ahead, when the daemon starts, on a pool of
+# threads. A phrase is rendered once at a time: asking for a phrase that is
+# being rendered waits for it rather than rendering it again.
+#
+# Backends:
+#  - GoogleTTS, Google Text-to-Speech as voice.py always used it, the mp3 files
+#    being kept on disk and decoded with mpg123
+#  - OfflineTTS, a stand-in needing neither the network nor other programs,
+#    saying each word as a short tone, for tests and the simulator
+# Sinks:
+#  - AplaySink, a long-lived aplay process playing the PCM written to it
+#  - NullSink, only taking the time the phrases would take to play
+
+import os
+import math
+import time
+import struct
+import hashlib
+import threading
+import subprocess
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Format of all the audio: signed 16 bits little endian samples, mono
+SAMPLE_RATE = 24000
+SAMPLE_BYTES = 2
+
+# Seconds to wait at most for a phrase to be rendered
+RENDER_TIMEOUT = 30
+
+# This method returns how many seconds the PCM audio <pcm> lasts
+def duration(pcm):
+    return float(len(pcm)) / (SAMPLE_RATE * SAMPLE_BYTES)
+
+# This method decodes the mp3 file <path> into PCM audio
+def decodeMp3(path):
+    return subprocess.check_output(['mpg123', '-q', '-s', '-m', '-e', 's16',
+                                    '-r', str(SAMPLE_RATE), path])
+
+# Google Text-to-Speech, downloading each phrase once into <cacheDir>
+class GoogleTTS:
+    def __init__(self, cacheDir="./tts", lang='it'):
+        self.cacheDir = cacheDir
+        self.lang = lang
+        if not os.path.isdir(cacheDir):
+            os.mkdir(cacheDir)
+
+    def filename(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return self.cacheDir + "/" + hashlib.md5(text).hexdigest() + ".mp3"
+
+    # This method returns the PCM audio of <text>, downloading it again if
+    # <fresh>, or if it was never downloaded
+    def render(self, text, fresh=False):
+        path = self.filename(text)
+        if fresh or not os.path.isfile(path):
+            # Only needed when something has to be downloaded
+            from gtts import gTTS
+            gTTS(text=text, lang=self.lang).save(path + ".part")
+            os.rename(path + ".part", path)
+        return decodeMp3(path)
+
+# Offline stand-in of a text to speech service, saying every word as a tone
+# whose pitch depends on the word. <delay> seconds are spent on each phrase,
+# to stand for the time a real service takes.
+class OfflineTTS:
+    def __init__(self, wordSecs=0.12, gapSecs=0.04, delay=0):
+        self.wordSecs = wordSecs
+        self.gapSecs = gapSecs
+        self.delay = delay
+
+    def render(self, text, fresh=False):
+        time.sleep(self.delay)
+        pcm = []
+        gap = b'\0' * (int(self.gapSecs * SAMPLE_RATE) * SAMPLE_BYTES)
+        for word in text.split():
+            if not isinstance(word, bytes):
+                word = word.encode('utf-8')
+            frequency = 300 + int(hashlib.md5(word).hexdigest()[:4], 16) % 500
+            samples = int(self.wordSecs * SAMPLE_RATE)
+            pcm.append(struct.pack('<%dh' % samples, *[
+                int(8000 * math.sin(2 * math.pi * frequency * k / SAMPLE_RATE))
+                for k in range(samples)]))
+            pcm.append(gap)
+        return b''.join(pcm)
+
+# The PCM audio of the phrases said last, taking at most <maxBytes>
+class PcmCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            pcm = self.entries.pop(key, None)
+            if pcm is not None:
+                # Back to the end, as the most recently used
+                self.entries[key] = pcm
+            return pcm
+
+    def put(self, key, pcm):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = pcm
+            self.size += len(pcm)
+            # The entry just put stays, however large
+            while self.size > self.maxBytes and len(self.entries) > 1:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def has(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def drop(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+# A long-lived aplay process playing the PCM audio written on its standard
+# input. It is started on the first phrase, and again if it died.
+class AplaySink:
+    def __init__(self, bufferSecs=0.1):
+        self.bufferSecs = bufferSecs
+        self.process = None
+
+    def command(self):
+        return ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1',
+                '-r', str(SAMPLE_RATE), '-B', str(int(self.bufferSecs * 1e6))]
+
+    def start(self):
+        self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE)
+
+    # This method plays <pcm>, returning once it has been played. The pipe
+    # takes the audio well before it is played, so the time it lasts is waited.
+    def write(self, pcm):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        start = time.time()
+        try:
+            self.process.stdin.write(pcm)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            # Died since, try once more with a new one
+            self.start()
+            start = time.time()
+            self.process.stdin.write(pcm)
+            self.process.stdin.flush()
+        time.sleep(max(0, start + duration(pcm) + self.bufferSecs - time.time()))
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+# A sink playing nothing, taking the time the audio lasts times <timeScale>
+class NullSink:
+    def __init__(self, timeScale=1.0):
+        self.timeScale = timeScale
+        self.played = 0
+
+    def write(self, pcm):
+        self.played += 1
+        time.sleep(duration(pcm) * self.timeScale)
+
+    def close(self):
+        pass
+
+# The voice output service, saying phrases rendered by <tts> through <sink>.
+# Phrases are kept in a cache of <cacheBytes>, about three minutes of audio per
+# 8MB, and rendered by <workers> threads.
+class Speaker:
+    def __init__(self, tts, sink, cacheBytes=16 << 20, workers=4):
+        self.tts = tts
+        self.sink = sink
+        self.cache = PcmCache(cacheBytes)
+        self.pool = ThreadPool(workers)
+        # The results of the phrases being rendered, by key
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.sinkLock = threading.Lock()
+        self.renders = 0
+
+    # Phrases are keyed ('text', <text>), and sound files ('file', <path>)
+    def load(self, key, fresh):
+        try:
+            kind, value = key
+            if kind == 'file':
+                pcm = decodeMp3(value)
+            else:
+                pcm = self.tts.render(value, fresh)
+            self.renders += 1
+            self.cache.put(key, pcm)
+            return pcm
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    # This method has <key> rendered on the pool unless it is known already,
+    # returning the pending result, or None if it is in the cache
+    def request(self, key, fresh=False):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if fresh:
+                self.cache.drop(key)
+            elif self.cache.has(key):
+                return None
+            result = self.pool.apply_async(self.load, (key, fresh))
+            self.pending[key] = result
+            return result
+
+    # This method renders the phrases <texts> and sound files <paths> in the
+    # background, for them to be said at once later
+    def prefetch(self, texts=(), paths=()):
+        for text in texts:
+            self.request(('text', text))
+        for path in paths:
+            self.request(('file', path))
+
+    # This method waits for everything prefetched to be rendered
+    def waitPrefetch(self, timeout=RENDER_TIMEOUT):
+        with self.lock:
+            results = list(self.pending.values())
+        for result in results:
+            result.wait(timeout)
+
+    def pcm(self, key, fresh=False):
+        pcm = None if fresh else self.cache.get(key)
+        while pcm is None:
+            result = self.request(key, fresh)
+            if result is not None:
+                pcm = result.get(RENDER_TIMEOUT)
+            else:
+                # Evicted again meanwhile
+                pcm = self.cache.get(key)
+            fresh = False
+        return pcm
+
+    def say(self, pcm):
+        with self.sinkLock:
+            self.sink.write(pcm)
+
+    # This method says <text>, rendering it again if <fresh>, and returns once
+    # it has been said
+    def talk(self, text, fresh=False):
+        self.say(self.pcm(('text', text), fresh))
+
+    # This method plays the mp3 file <path>
+    def play(self, path):
+        self.say(self.pcm(('file', path)))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.sink.close()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Persistent store of the engine's analysis, so positions searched once, in
+# this game or any earlier one, are answered at once.
+#
+# The store is an append-only file of fixed size records after a header:
+#
+#   header:  4s magic 'SFAN'
+#   record:  Q key, H move (from * 120 + to, NO_MOVE if none), H depth,
+#            i lower bound, i upper bound
+#
+# all little endian, keys being the Zobrist keys of sunfish. The whole file is
+# read into a dict when the store is opened, later records of a position
+# replacing earlier ones, and new records are appended by a background thread.
+# When most of the file is made of replaced records it is rewritten on opening.
+
+import os
+import struct
+import threading
+from collections import namedtuple
+
+MAGIC = b'SFAN'
+RECORD = struct.Struct('<QHHii')
+NO_MOVE = 0xffff
+
+# lower <= score <= upper, from a search of the given depth
+Analysis = namedtuple('Analysis', 'move depth lower upper')
+
+class AnalysisStore:
+    ''' Analysis of positions by Zobrist key, kept in a file '''
+    def __init__(self, path, flush_interval=5):
+        self.path = path
+        self.entries = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        records = self._load()
+        if records > 2 * len(self.entries) + 1024:
+            self._compact()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.file.flush()
+        # Writes happen in the background, every flush_interval seconds
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,))
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _load(self):
+        ''' Reads the file into the dict, returning the number of records '''
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not an analysis store' % self.path)
+        # A record cut short by a crash while writing is dropped
+        end = len(MAGIC) + (len(data) - len(MAGIC)) // RECORD.size * RECORD.size
+        if end != len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        records = 0
+        for offset in range(len(MAGIC), end, RECORD.size):
+            key, move, depth, lower, upper = RECORD.unpack_from(data, offset)
+            self.entries[key] = Analysis(None if move == NO_MOVE else divmod(move, 120), depth, lower, upper)
+            records += 1
+        return records
+
+    def _compact(self):
+        ''' Rewrites the file with only the current entries '''
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(MAGIC)
+            for key, entry in self.entries.items():
+                f.write(self._pack(key, entry))
+        os.rename(self.path + '.tmp', self.path)
+
+    def _pack(self, key, entry):
+        move = NO_MOVE if entry.move is None else entry.move[0] * 120 + entry.move[1]
+        return RECORD.pack(key, move, entry.depth, entry.lower, entry.upper)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, move, depth, lower, upper):
+        ''' Records a search of the position, unless a deeper one is known '''
+        old = self.entries.get(key)
+        if old is not None and old.depth > depth:
+            return
+        entry = Analysis(move, depth, lower, upper)
+        if entry == old:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.pending.append(self._pack(key, entry))
+
+    def flush(self):
+        ''' Writes the records not on disk yet '''
+        with self.lock:
+            if self.pending:
+                self.file.write(b''.join(self.pending))
+                self.file.flush()
+                self.pending = []
+
+    def _flush_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
@@ -2,12 +2,23 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import re, sys, time
-from itertools import count
-from collections import OrderedDict, namedtuple
+import re, sys, time, random
+import multiprocessing, threading
+from collections import namedtuple
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The table size is the memory budget, in bytes, shared by the transposition
+# tables of a Searcher. The tables have a fixed number of slots, so once they
+# are full old entries get replaced instead of growing the heap.
+TABLE_BYTES = 64 * 1024 * 1024
+
+# Rough estimate of the memory held by one table slot, counting the slot
+# itself as well as the key and value objects it keeps alive.
+ENTRY_BYTES = 256
+
+# Depth a result of the analysis store must have been searched to for a timed
+# search to play it without searching. Shallower results only seed the tables
+# of the search, which then stores a deeper one.
+STORE_DEPTH = 8
 
 # Mate value must be greater than 8*queen + 2*(rook+knight+bishop)
 # King value is set to twice this value such that if the opponent is
@@ -52,6 +63,24 @@ directions = {
     'K': (N, E, S, W, N+E, S+E, S+W, N+W)
 }
 
+# Precomputed move tables. For every piece and square, the rays of squares the
+# piece can slide along before leaving the board, and the targets of knights
+# and kings.
+_onboard = [not c.isspace() for c in initial]
+def _rays(p, i):
+    rays = []
+    for d in directions[p]:
+        ray = []
+        j = i + d
+        while _onboard[j]:
+            ray.append(j)
+            if p in 'NK': break
+            j += d
+        if ray: rays.append(tuple(ray))
+    return tuple(rays)
+rays = {p: [_rays(p, i) if _onboard[i] else () for i in range(120)] for p in 'NBRQK'}
+jumps = {p: [tuple(ray[0] for ray in rays[p][i]) for i in range(120)] for p in 'NK'}
+
 pst = {
     'P': (0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
         0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
@@ -128,11 +157,82 @@ pst = {
 }
 
 
+# Piece ranks for MVV-LVA ordering of captures. The king passant square counts
+# as capturing the king.
+mvv_lva = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 15}
+
+# Quiet moves whose piece-square gain alone reaches QS_LIMIT, such as knights
+# leaving the corners. QSearch searches them along with the captures, so they
+# are generated by gen_captures rather than gen_quiets. For every piece and
+# square, the targets of such moves.
+def _qs_quiets(p, i):
+    if not _onboard[i]:
+        return frozenset()
+    if p == 'P':
+        targets = [i+N] if not A8 <= i+N <= H8 else []
+        if i >= A1+N: targets.append(i+N+N)
+    else:
+        targets = [j for ray in rays[p][i] for j in ray]
+    return frozenset(j for j in targets if pst[p][j] - pst[p][i] >= QS_LIMIT)
+qs_quiets = {p: [_qs_quiets(p, i) for i in range(120)] for p in 'PNBRQK'}
+
+###############################################################################
+# Zobrist hashing
+###############################################################################
+
+# Positions are identified by a 64 bit key, the xor of a random number for each
+# piece on its square, the castling rights and the ep/kp squares. Each Position
+# also carries the key of its rotated board, so rotations just swap the two.
+# The random numbers come from a fixed seed, so keys are the same on every run
+# and can be stored on disk.
+_zrandom = random.Random(0x5f3759df)
+zobrist = {p: tuple(_zrandom.getrandbits(64) for i in range(120)) for p in 'PNBRQKpnbrqk'}
+zobrist['.'] = (0,) * 120
+zobrist_rotated = {p: tuple(zobrist[p.swapcase()][119-i] for i in range(120)) for p in zobrist}
+zobrist_castling = tuple(_zrandom.getrandbits(64) for i in range(4))
+zobrist_ep = tuple(_zrandom.getrandbits(64) for i in range(120))
+zobrist_kp = tuple(_zrandom.getrandbits(64) for i in range(120))
+
+def _zobrist_rights(wc, bc):
+    key = rkey = 0
+    # The rotated position has the castling rights swapped
+    rotated = zobrist_castling[2:] + zobrist_castling[:2]
+    for right, z, rz in zip(wc + bc, zobrist_castling, rotated):
+        if right:
+            key ^= z
+            rkey ^= rz
+    return key, rkey
+
+zobrist_rights = {(wc, bc): _zobrist_rights(wc, bc)
+    for wc in ((False, False), (False, True), (True, False), (True, True))
+    for bc in ((False, False), (False, True), (True, False), (True, True))}
+
+def zobrist_state(wc, bc, ep, kp):
+    ''' The key and rotated key of everything but the pieces '''
+    key, rkey = zobrist_rights[wc, bc]
+    if ep:
+        key ^= zobrist_ep[ep]
+        rkey ^= zobrist_ep[119-ep]
+    if kp:
+        key ^= zobrist_kp[kp]
+        rkey ^= zobrist_kp[119-kp]
+    return key, rkey
+
+def zobrist_hash(board, wc, bc, ep, kp):
+    ''' Computes the key and rotated key of a position from scratch '''
+    key, rkey = zobrist_state(wc, bc, ep, kp)
+    for i, p in enumerate(board):
+        if p in zobrist:
+            key ^= zobrist[p][i]
+            rkey ^= zobrist_rotated[p][i]
+    return key, rkey
+
+
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+class Position(namedtuple('Position', 'board score wc bc ep kp key rkey')):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -140,52 +240,185 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    key - the zobrist key of the position
+    rkey - the zobrist key of the rotated position
     """
 
+    def __new__(cls, board, score, wc, bc, ep, kp, key=None, rkey=None):
+        # The keys are only computed from scratch for new games, moves
+        # update them incrementally.
+        if key is None:
+            key, rkey = zobrist_hash(board, wc, bc, ep, kp)
+        return super(Position, cls).__new__(cls, board, score, wc, bc, ep, kp, key, rkey)
+
+    def pieces(self):
+        ''' Squares and kinds of our pieces, in board order. The squares are
+        found with str.find, which scans the board in C, so the generators
+        built on top only visit our own pieces. '''
+        board = self.board
+        found = []
+        for p in 'PNBRQK':
+            i = board.find(p)
+            while i != -1:
+                found.append((i, p))
+                i = board.find(p, i+1)
+        found.sort()
+        return found
+
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
-        # as defined in the 'directions' map. The rays are broken e.g. by
-        # captures or immediately in case of pieces such as knights.
-        for i, p in enumerate(self.board):
-            if not p.isupper(): continue
-            for d in directions[p]:
-                for j in count(i+d, d):
-                    q = self.board[j]
-                    # Stay inside the board, and off friendly pieces
-                    if q.isspace() or q.isupper(): break
-                    # Pawn move, double move and capture
-                    if p == 'P' and d in (N, N+N) and q != '.': break
-                    if p == 'P' and d == N+N and (i < A1+N or self.board[i+N] != '.'): break
-                    if p == 'P' and d in (N+W, N+E) and q == '.' and j not in (self.ep, self.kp): break
+        # as precomputed in the 'rays' table. The rays are broken e.g. by
+        # captures, while knights and kings just jump to their targets.
+        board, wc, ep, kp = self.board, self.wc, self.ep, self.kp
+        for i, p in self.pieces():
+            # Pawn move, double move and capture
+            if p == 'P':
+                if board[i+N] == '.':
+                    yield (i, i+N)
+                    if i >= A1+N and board[i+N+N] == '.': yield (i, i+N+N)
+                for j in (i+N+W, i+N+E):
+                    if board[j].islower() or j in (ep, kp): yield (i, j)
+                continue
+            if p in 'NK':
+                for j in jumps[p][i]:
+                    if not board[j].isupper(): yield (i, j)
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = board[j]
+                    # Stay off friendly pieces
+                    if q.isupper(): break
                     # Move it
                     yield (i, j)
-                    # Stop crawlers from sliding, and sliding after captures
-                    if p in 'PNK' or q.islower(): break
+                    # Stop sliding after captures
+                    if q.islower(): break
                     # Castling, by sliding the rook next to the king
-                    if i == A1 and self.board[j+E] == 'K' and self.wc[0]: yield (j+E, j+W)
-                    if i == H1 and self.board[j+W] == 'K' and self.wc[1]: yield (j+W, j+E)
+                    if i == A1 and board[j+E] == 'K' and wc[0]: yield (j+E, j+W)
+                    if i == H1 and board[j+W] == 'K' and wc[1]: yield (j+W, j+E)
+
+    def gen_captures(self):
+        ''' Like gen_moves, but only captures, promotions, king passant
+        captures and the quiet moves of qs_quiets, with the most valuable
+        victims first and then the least valuable attackers '''
+        board, ep, kp = self.board, self.ep, self.kp
+        moves = []
+        for i, p in self.pieces():
+            big = qs_quiets[p][i]
+            if p == 'P':
+                for j in (i+N+W, i+N+E):
+                    if board[j].islower() or j in (ep, kp): moves.append((i, j))
+                if A8 <= i+N <= H8 and board[i+N] == '.': moves.append((i, i+N))
+                if big and board[i+N] == '.':
+                    if i+N in big: moves.append((i, i+N))
+                    if i+N+N in big and board[i+N+N] == '.': moves.append((i, i+N+N))
+                continue
+            if p in 'NK':
+                for j in jumps[p][i]:
+                    if board[j].islower() or board[j] == '.' and (abs(j-kp) < 2 or j in big):
+                        moves.append((i, j))
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = board[j]
+                    if q == '.':
+                        if abs(j-kp) < 2 or j in big: moves.append((i, j))
+                        continue
+                    if q.islower(): moves.append((i, j))
+                    break
+        moves.sort(key=self.capture_order, reverse=True)
+        return moves
+
+    def capture_order(self, move):
+        i, j = move
+        p, q = self.board[i], self.board[j]
+        victim = mvv_lva['K'] if abs(j-self.kp) < 2 else mvv_lva.get(q.upper(), 0)
+        if p == 'P':
+            if j == self.ep: victim = mvv_lva['P']
+            if A8 <= j <= H8: victim += mvv_lva['Q'] - mvv_lva['P']
+        return 16*victim - mvv_lva[p]
+
+    def gen_quiets(self):
+        ''' The moves of gen_moves not returned by gen_captures '''
+        board, wc, kp = self.board, self.wc, self.kp
+        for i, p in self.pieces():
+            big = qs_quiets[p][i]
+            if p == 'P':
+                # Pushes to the last rank are promotions, and so captures
+                if board[i+N] == '.' and not A8 <= i+N <= H8:
+                    if i+N not in big: yield (i, i+N)
+                    if i >= A1+N and board[i+N+N] == '.' and i+N+N not in big: yield (i, i+N+N)
+                continue
+            if p in 'NK':
+                for j in jumps[p][i]:
+                    if board[j] == '.' and abs(j-kp) >= 2 and j not in big: yield (i, j)
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    if board[j] != '.': break
+                    if abs(j-kp) >= 2 and j not in big: yield (i, j)
+                    if i == A1 and board[j+E] == 'K' and wc[0]: yield (j+E, j+W)
+                    if i == H1 and board[j+W] == 'K' and wc[1]: yield (j+W, j+E)
+
+    def attacks(self, j):
+        ''' Whether one of our pieces can capture on square j '''
+        board = self.board
+        if board[j+S+W] == 'P' or board[j+S+E] == 'P':
+            return True
+        for p in 'NK':
+            for k in jumps[p][j]:
+                if board[k] == p: return True
+        for p, sliders in (('R', 'RQ'), ('B', 'BQ')):
+            for ray in rays[p][j]:
+                for k in ray:
+                    q = board[k]
+                    if q == '.': continue
+                    if q in sliders: return True
+                    break
+        return False
+
+    def can_capture_king(self):
+        ''' Same as any(self.value(m) >= MATE_LOWER for m in self.gen_moves()),
+        that is the opponent left its king in check or castled through check '''
+        if self.kp:
+            return any(self.value(m) >= MATE_LOWER for m in self.gen_moves())
+        k = self.board.find('k')
+        return k != -1 and self.attacks(k)
 
     def rotate(self):
         ''' Rotates the board, preserving enpassant '''
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0)
+            119-self.kp if self.kp else 0,
+            self.rkey, self.key)
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
+        key, rkey = self.key, self.rkey
+        if self.ep or self.kp:
+            k, rk = zobrist_state(self.wc, self.bc, self.ep, self.kp)
+            k0, rk0 = zobrist_rights[self.wc, self.bc]
+            key, rkey = key ^ k ^ k0, rkey ^ rk ^ rk0
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0)
+            self.bc, self.wc, 0, 0, rkey, key)
 
-    def move(self, move):
+    def move(self, move, value=None):
+        ''' The position after <move>, whose value may be passed if known '''
         i, j = move
         p, q = self.board[i], self.board[j]
-        put = lambda board, i, p: board[:i] + p + board[i+1:]
+        # The keys are updated for every square we put a piece on, starting
+        # from the current keys without the old rights, ep and kp
+        k, rk = zobrist_state(self.wc, self.bc, self.ep, self.kp)
+        keys = [self.key ^ k, self.rkey ^ rk]
+        def put(board, i, p):
+            keys[0] ^= zobrist[board[i]][i] ^ zobrist[p][i]
+            keys[1] ^= zobrist_rotated[board[i]][i] ^ zobrist_rotated[p][i]
+            return board[:i] + p + board[i+1:]
         # Copy variables and reset ep and kp
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
-        score = self.score + self.value(move)
+        score = self.score + (self.value(move) if value is None else value)
         # Actual move
         board = put(board, j, board[i])
         board = put(board, i, '.')
@@ -209,8 +442,9 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 ep = i + N
             if j - i in (N+W, N+E) and q == '.':
                 board = put(board, j+S, '.')
+        k, rk = zobrist_state(wc, bc, ep, kp)
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp).rotate()
+        return Position(board, score, wc, bc, ep, kp, keys[0] ^ k, keys[1] ^ rk).rotate()
 
     def value(self, move):
         i, j = move
@@ -242,37 +476,140 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
 
-# The normal OrderedDict doesn't update the position of a key in the list,
-# when the value is changed.
-class LRUCache:
-    '''Store items in the order the keys were last added'''
-    def __init__(self, size):
-        self.od = OrderedDict()
-        self.size = size
+class TranspositionTable:
+    '''Fixed size hash table, preferring deep and recent entries on collisions'''
+    def __init__(self, size_bytes):
+        self.size = max(1, int(size_bytes) // ENTRY_BYTES)
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.keys = [None] * self.size
+        self.values = [None] * self.size
+        self.depths = [0] * self.size
+        self.ages = [0] * self.size
+        self.used = self.hits = self.misses = self.stores = self.collisions = 0
+
+    def new_search(self):
+        ''' Entries stored before this call become candidates for replacement '''
+        self.generation += 1
 
     def get(self, key, default=None):
-        try: self.od.move_to_end(key)
-        except KeyError: return default
-        return self.od[key]
+        i = hash(key) % self.size
+        if self.keys[i] == key:
+            self.hits += 1
+            self.ages[i] = self.generation
+            return self.values[i]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, depth=0):
+        i = hash(key) % self.size
+        old = self.keys[i]
+        if old is None:
+            self.used += 1
+        elif old != key:
+            self.collisions += 1
+            # Keep deeper entries from the current search, anything stored
+            # during an earlier search may be overwritten.
+            if self.ages[i] == self.generation and depth < self.depths[i]:
+                return
+        self.keys[i] = key
+        self.values[i] = value
+        self.depths[i] = depth
+        self.ages[i] = self.generation
+        self.stores += 1
 
-    def __setitem__(self, key, value):
-        try: del self.od[key]
-        except KeyError:
-            if len(self.od) == self.size:
-                self.od.popitem(last=False)
-        self.od[key] = value
+    def stats(self):
+        return {
+            'size': self.size, 'used': self.used,
+            'fill': self.used / float(self.size),
+            'hits': self.hits, 'misses': self.misses,
+            'stores': self.stores, 'collisions': self.collisions}
+
+class TimeUp(Exception):
+    ''' Raised by bound() once the search is out of time or nodes '''
+
+class TimeManager:
+    ''' The limits of a search. No iteration is started after the soft time
+    limit or beyond the depth limit, while the iteration under way is aborted
+    at the hard time limit or once the node limit is reached. Times are in
+    seconds from the creation of the TimeManager. '''
+    def __init__(self, soft=None, hard=None, nodes=None, depth=None):
+        self.start = time.time()
+        self.soft = soft
+        self.hard = hard
+        self.nodes = nodes
+        self.depth = depth
+
+    def deadline(self):
+        return None if self.hard is None else self.start + self.hard
+
+    def next_iteration(self, depth, nodes):
+        ''' Whether to search to the given depth, having searched nodes so far '''
+        return ((self.depth is None or depth <= self.depth) and
+                (self.nodes is None or nodes < self.nodes) and
+                (self.soft is None or time.time() - self.start < self.soft))
+
+def move_time(secs):
+    ''' Limits for a search taking at most secs. Starting an iteration after
+    half of it is wasted, as it would most likely be aborted. '''
+    return TimeManager(soft=secs/2., hard=secs)
+
+def clock_time(remaining, increment=0, moves_to_go=None):
+    ''' Limits for a move of a game played on a clock, with remaining seconds
+    left and increment seconds added after each move. The time is shared
+    evenly by the moves to go, 30 of them if the clock has no time control. '''
+    share = remaining / float(moves_to_go or 30) + increment
+    hard = min(2 * share, remaining / 2.)
+    return TimeManager(soft=min(share, hard) / 2., hard=hard)
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = LRUCache(TABLE_SIZE)
-        self.tp_move = LRUCache(TABLE_SIZE)
+    def __init__(self, table_bytes=TABLE_BYTES, workers=1, tablebase=None, store=None):
+        # The table budget is shared with the worker processes, if any
+        if workers > 1:
+            table_bytes //= workers + 1
+        self.tp_score = TranspositionTable(table_bytes // 2)
+        self.tp_move = TranspositionTable(table_bytes // 2)
         self.nodes = 0
+        # Absolute time and node count at which bound() gives up, if any
+        self.deadline = None
+        self.max_nodes = None
+        # Move and score of the last complete iteration of the search
+        self.best = None
+        # Endgame tables, a tablebase.Tablebase, scoring the positions they
+        # cover without searching them
+        self.tablebase = tablebase
+        # Persistent store.AnalysisStore the results of searches are kept in,
+        # and positions found in it are answered from
+        self.store = store
+        # With more than one worker, the root moves are split over a pool of
+        # processes. The pool is started here, so the caller decides which
+        # resources it inherits, and stopped by close().
+        self.workers = workers
+        self.searches = 0
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, _init_worker,
+                (self.__class__, table_bytes, tablebase))
+        # Background search started by ponder(), and the event telling it to
+        # stop, which only that search waits for
+        self.ponder_thread = None
+        self.ponder_stop = threading.Event()
+        self.ponder_pos = None
+        self.ponder_best = None
+        self.ponder_start = 0
+
+    def stats(self):
+        return {'score': self.tp_score.stats(), 'move': self.tp_move.stats()}
 
     def bound(self, pos, gamma, depth, root=True):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         self.nodes += 1
+        if self.nodes & 1023 == 0 and self.out_of_time():
+            raise TimeUp()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for calmness, and so there is no reason to keep different depths in the transposition table.
         depth = max(depth, 0)
@@ -284,11 +621,18 @@ class Searcher:
         if pos.score <= -MATE_LOWER:
             return -MATE_UPPER
 
+        # Positions with a king and one piece against a king are looked up in
+        # the endgame tables, if any
+        if not root and self.tablebase is not None and pos.board.count('.') >= 61:
+            score = self.tablebase.probe(pos.key, pos.board)
+            if score is not None:
+                return score
+
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
+        entry = self.tp_score.get((pos.key, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
+        if entry.lower >= gamma and (not root or self.tp_move.get(pos.key) is not None):
             return entry.lower
         if entry.upper < gamma:
             return entry.upper
@@ -305,14 +649,24 @@ class Searcher:
             # For QSearch we have a different kind of null-move
             if depth == 0:
                 yield None, pos.score
-            # Then killer move. We search it twice, but the tp will fix things for us. Note, we don't have to check for legality, since we've already done it before. Also note that in QS the killer must be a capture, otherwise we will be non deterministic.
-            killer = self.tp_move.get(pos)
-            if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
-            # Then all the other moves
-            for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+            # Then killer move. Note, we don't have to check for legality, since we've already done it before. Also note that in QS the killer must be a capture, otherwise we will be non deterministic.
+            killer = self.tp_move.get(pos.key)
+            if killer:
+                value = pos.value(killer)
+                if depth > 0 or value >= QS_LIMIT:
+                    yield killer, -self.bound(pos.move(killer, value), 1-gamma, depth-1, root=False)
+            # Then captures, the only moves QSearch looks at. Each move value
+            # is computed once, and passed on to Position.move.
+            for move in pos.gen_captures():
+                if move == killer: continue
+                value = pos.value(move)
+                if depth > 0 or value >= QS_LIMIT:
+                    yield move, -self.bound(pos.move(move, value), 1-gamma, depth-1, root=False)
+            # Then the quiet moves, only generated if nothing above cut off
+            if depth > 0:
+                for value, move in self.quiet_moves(pos):
+                    if move == killer: continue
+                    yield move, -self.bound(pos.move(move, value), 1-gamma, depth-1, root=False)
 
         # Run through the moves, shortcutting when possible
         best = -MATE_UPPER
@@ -320,7 +674,7 @@ class Searcher:
             best = max(best, score)
             if best >= gamma:
                 # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                self.tp_move.put(pos.key, move, depth)
                 break
 
         # Stalemate checking is a bit tricky: Say we failed low, because
@@ -334,19 +688,40 @@ class Searcher:
         # but only if depth == 1, so that's probably fair enough.
         # (Btw, at depth 1 we can also mate without realizing.)
         if best < gamma and best < 0 and depth > 0:
-            is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
+            is_dead = lambda pos: pos.can_capture_king()
             if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
                 in_check = is_dead(pos.nullmove())
                 best = -MATE_UPPER if in_check else 0
 
         # Table part 2
         if best >= gamma:
-            self.tp_score[(pos, depth, root)] = Entry(best, entry.upper)
+            self.tp_score.put((pos.key, depth, root), Entry(best, entry.upper), depth)
         if best < gamma:
-            self.tp_score[(pos, depth, root)] = Entry(entry.lower, best)
+            self.tp_score.put((pos.key, depth, root), Entry(entry.lower, best), depth)
 
         return best
 
+    def quiet_moves(self, pos):
+        ''' The quiet moves of pos with their values, best first '''
+        return sorted(((pos.value(m), m) for m in pos.gen_quiets()), reverse=True)
+
+    def mtd(self, pos, depth, root=True):
+        """ MTD-bi search of pos to the given depth """
+        # The inner loop is a binary search on the score of the position.
+        # Inv: lower <= score <= upper
+        # 'while lower != upper' would work, but play tests show a margin of 20 plays better.
+        lower, upper = -MATE_UPPER, MATE_UPPER
+        while lower < upper - EVAL_ROUGHNESS:
+            gamma = (lower+upper+1)//2
+            score = self.bound(pos, gamma, depth, root)
+            if score >= gamma:
+                lower = score
+            if score < gamma:
+                upper = score
+        # We want to make sure the move to play hasn't been kicked out of the table,
+        # So we make another call that must always fail high and thus produce a move.
+        return self.bound(pos, lower, depth, root)
+
     # secs over maxn is a breaking change. Can we do this?
     # I guess I could send a pull request to deep pink
     # Why include secs at all?
@@ -358,32 +733,233 @@ class Searcher:
         # limit exception. Hence we bound the ply.
         for depth in range(1, 1000):
             self.depth = depth
-            # The inner loop is a binary search on the score of the position.
-            # Inv: lower <= score <= upper
-            # 'while lower != upper' would work, but play tests show a margin of 20 plays better.
-            lower, upper = -MATE_UPPER, MATE_UPPER
-            while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower+upper+1)//2
-                score = self.bound(pos, gamma, depth)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
-            # We want to make sure the move to play hasn't been kicked out of the table,
-            # So we make another call that must always fail high and thus produce a move.
-            score = self.bound(pos, lower, depth)
+            self.mtd(pos, depth)
 
             # Yield so the user may inspect the search
             yield
 
-    def search(self, pos, secs):
-        start = time.time()
-        for _ in self._search(pos):
-            if time.time() - start > secs:
+    def _position(self, pos):
+        ''' The object bound() works on for the given Position '''
+        return pos
+
+    def new_search(self):
+        self.tp_score.new_search()
+        self.tp_move.new_search()
+
+    def out_of_time(self):
+        return (self.ponder_stop.is_set() or
+                self.deadline is not None and time.time() > self.deadline or
+                self.max_nodes is not None and self.nodes >= self.max_nodes)
+
+    def search(self, pos, secs=None, limits=None):
+        ''' Searches pos for secs seconds, or within the given TimeManager,
+        returning the best move and its score '''
+        if limits is None:
+            limits = move_time(secs)
+        # If pos is the position being pondered, that search is given what is
+        # left of the hard limit and its result is played, else it is stopped
+        # and the tables it filled are used.
+        if self.ponder_thread is not None:
+            hit = pos.key == self.ponder_pos.key and limits.hard is not None
+            self.stop_pondering(max(0, self.ponder_start + limits.hard - time.time()) if hit else 0)
+            if hit and self.ponder_best is not None:
+                return self._remember(pos, self.ponder_best)
+        # Positions searched before, possibly in an earlier game, are answered
+        # from the store if they were searched deep enough, else the search
+        # starts from what was found then
+        hint = None
+        if self.store is not None:
+            entry = self.store.get(pos.key)
+            if entry is not None and entry.move in pos.gen_moves():
+                if entry.depth >= (STORE_DEPTH if limits.depth is None else limits.depth):
+                    return entry.move, entry.lower
+                hint = entry
+        # Endgames covered by the tables are played without searching
+        if self.tablebase is not None:
+            best = self.tablebase.best_move(pos)
+            if best is not None:
+                return best
+        if self.pool is not None:
+            return self._remember(pos, self._parallel_search(pos, limits, hint))
+        self.new_search()
+        self._hint(pos, hint)
+        return self._remember(pos, self._iterate(pos, limits))
+
+    def _hint(self, pos, entry):
+        ''' Seeds the tables with the store entry of pos, if any '''
+        if entry is not None:
+            self.tp_move.put(pos.key, entry.move, entry.depth)
+            self.tp_score.put((pos.key, entry.depth, True), Entry(entry.lower, entry.upper), entry.depth)
+
+    def _remember(self, pos, best):
+        ''' Adds the result of a search of pos to the store, if any '''
+        if self.store is not None and best is not None and best[0] is not None:
+            entry = self.tp_score.get((pos.key, self.depth, True))
+            if entry is None:
+                entry = Entry(best[1], best[1])
+            self.store.put(pos.key, best[0], self.depth, entry.lower, entry.upper)
+        return best
+
+    def _iterate(self, pos, limits):
+        ''' Iterative deepening of pos until the limits are reached, returning
+        the move and score of the last complete iteration, whose depth is left
+        in self.depth '''
+        self.best = None
+        depth = 0
+        try:
+            for _ in self._search(self._position(pos)):
+                depth = self.depth
+                # If the game hasn't finished we can retrieve our move from the
+                # transposition table.
+                self.best = self.tp_move.get(pos.key), self.tp_score.get((pos.key, self.depth, True)).lower
+                # The first iteration is always completed, so that there is a
+                # move to play, and the limits are enforced from there on.
+                self.deadline = limits.deadline()
+                self.max_nodes = limits.nodes
+                if not limits.next_iteration(self.depth + 1, self.nodes):
+                    break
+        except TimeUp:
+            pass
+        finally:
+            self.deadline = self.max_nodes = None
+        self.depth = depth
+        return self.best
+
+    def _parallel_search(self, pos, limits, hint=None):
+        """ Root splitting search. At each depth the best root move so far is
+        searched here while the workers test the other root moves, with null
+        window searches, against the score of the previous depth, searching
+        fully the moves beating it. Moves whose test doesn't settle them
+        against the new score of the first move are tested again against it.
+        Every search stops at the hard limit, and the best move of the deepest
+        depth searched is played, if need be from a partial iteration where
+        some moves were found to be better. The node limit is only checked
+        between iterations. """
+        deadline = limits.deadline()
+        timeout = None if deadline is None else deadline - time.time() + 10
+        self.searches += 1
+        self.new_search()
+        self._hint(pos, hint)
+        self.nodes = 0
+        moves = sorted(pos.gen_moves(), key=pos.value, reverse=True)
+        if not moves:
+            return None, -MATE_UPPER
+        # The move of the store first
+        if hint is not None:
+            moves.remove(hint.move)
+            moves.insert(0, hint.move)
+        # The first move is tested against its static score at depth 1
+        move, score = moves[0], pos.score + pos.value(moves[0])
+        self.depth = 0
+        for depth in range(1, 1000):
+            # The workers stop at the deadline by themselves
+            tests = self.pool.map_async(_search_move, [
+                (self.searches, pos, m, depth, score, deadline) for m in moves[1:]])
+            self.deadline = deadline
+            try:
+                first = -self.mtd(self._position(pos.move(moves[0])), depth-1, root=False)
+            except TimeUp:
+                tests.wait(timeout)
+                break
+            finally:
+                self.deadline = None
+            results = tests.get(timeout)
+            self.nodes += sum(nodes for _, _, nodes in results)
+            # Results above the score tested against are lower bounds of the
+            # scores of better moves, and those below it upper bounds, which
+            # only refute the moves they don't leave above the first one.
+            unsettled = [m for s, m, _ in results if s is not None and first < s <= score]
+            if unsettled:
+                retests = self.pool.map_async(_search_move, [
+                    (self.searches, pos, m, depth, first, deadline) for m in unsettled]).get(timeout)
+                self.nodes += sum(nodes for _, _, nodes in retests)
+                results = [r for r in results if r[1] not in unsettled] + retests
+            # Bounds above first are only found for moves better than the
+            # first one, so any of them can be played even if other moves
+            # weren't searched in time.
+            score, move = max([(first, moves[0])] + [
+                (s, m) for s, m, _ in results if s is not None and s > first])
+            self.depth = depth
+            moves.remove(move)
+            moves.insert(0, move)
+            if any(s is None for s, _, _ in results) or not limits.next_iteration(depth + 1, self.nodes):
                 break
-        # If the game hasn't finished we can retrieve our move from the
-        # transposition table.
-        return self.tp_move.get(pos), self.tp_score.get((pos, self.depth, True)).lower
+        self.tp_move.put(pos.key, move, self.depth)
+        return move, score
+
+    def ponder(self, pos):
+        ''' Starts searching in the background the position we expect after the
+        reply to our move, pos being the position right after our move. The
+        search runs until the next call to search() or stop_pondering(). '''
+        self.stop_pondering()
+        reply = self.tp_move.get(pos.key)
+        if reply is None:
+            return
+        self.ponder_pos = pos.move(reply)
+        self.ponder_best = None
+        self.ponder_start = time.time()
+        self.ponder_stop.clear()
+        self.ponder_thread = threading.Thread(target=self._ponder, args=(self.ponder_pos,))
+        self.ponder_thread.daemon = True
+        self.ponder_thread.start()
+
+    def _ponder(self, pos):
+        self.new_search()
+        self.ponder_best = self._iterate(pos, TimeManager())
+
+    def stop_pondering(self, secs=0):
+        ''' Lets the background search run for secs more seconds, and waits for it '''
+        if self.ponder_thread is None:
+            return
+        if secs > 0:
+            self.ponder_thread.join(secs)
+        self.ponder_stop.set()
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        self.ponder_stop.clear()
+
+    def close(self):
+        ''' Stops the background and parallel searches, if any '''
+        self.stop_pondering()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+# The Searcher of a worker process of a parallel search, and the number of
+# the search its tables were last used for
+_worker = None
+_worker_search = None
+
+def _init_worker(cls, table_bytes, tablebase):
+    global _worker
+    _worker = cls(table_bytes, tablebase=tablebase)
+
+def _search_move(args):
+    ''' Tests whether a root move scores above first, searching it fully if
+    it does. Returns its upper bound or score, or None if the deadline passed
+    first, and the nodes searched '''
+    global _worker_search
+    search, pos, move, depth, first, deadline = args
+    if search != _worker_search:
+        _worker.new_search()
+        _worker_search = search
+    nodes = _worker.nodes
+    if deadline is not None and time.time() > deadline:
+        return None, move, 0
+    _worker.deadline = deadline
+    score = None
+    try:
+        score = -_worker.bound(_worker._position(pos.move(move)), -first, depth-1, root=False)
+        # Moves beating the first one are searched again for their score, if
+        # there is time left, else the bound proving it is returned.
+        if score > first:
+            score = -_worker.mtd(_worker._position(pos.move(move)), depth-1, root=False)
+    except TimeUp:
+        pass
+    finally:
+        _worker.deadline = None
+    return score, move, _worker.nodes - nodes
 
 
 ###############################################################################
@@ -393,11 +969,6 @@ class Searcher:
 # Python 2 compatability
 if sys.version_info[0] == 2:
     input = raw_input
-    class NewOrderedDict(OrderedDict):
-        def move_to_end(self, key):
-            value = self.pop(key)
-            self[key] = value
-    OrderedDict = NewOrderedDict
 
 
 def parse(c):
@@ -0,0 +1,407 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+
+# Mutable board backend for the Sunfish search.
+#
+# sunfish.Position is immutable, so every searched node copies the 120 char
+# board a few times and then rotates it. Here the board is kept in two
+# bytearrays, one as seen by each player, which are updated in place by make()
+# and restored by unmake(). The side to move selects which of the two views is
+# used, so nothing is ever rotated or copied. Moves, scores and zobrist keys
+# are exactly the ones of the equivalent sunfish.Position, so the Searcher
+# below plays the same moves as sunfish.Searcher at the same depth.
+
+from __future__ import print_function
+import sunfish
+from sunfish import A1, H1, A8, H8, N, E, S, W, MATE_LOWER, MATE_UPPER, QS_LIMIT, Entry
+
+###############################################################################
+# Byte tables
+###############################################################################
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, EMPTY = [ord(c) for c in 'PNBRQK.']
+
+# Per byte lookups, replacing the str methods used by sunfish.Position
+isupper = [chr(c).isupper() for c in range(256)]
+islower = [chr(c).islower() for c in range(256)]
+swapcase = [ord(chr(c).swapcase()) if c < 128 else c for c in range(256)]
+jumper = [chr(c) in 'NK' for c in range(256)]
+officer = [chr(c) in 'RBNQ' for c in range(256)]
+
+rays = [None] * 256
+jumps = [None] * 256
+pst = [None] * 256
+mvv_lva = [0] * 256
+qs_quiets = [None] * 256
+zobrist = [None] * 256
+zobrist_rotated = [None] * 256
+for _p in 'PNBRQK':
+    rays[ord(_p)] = sunfish.rays.get(_p)
+    jumps[ord(_p)] = sunfish.jumps.get(_p)
+    # Captured pieces are scored with the table of their owner
+    pst[ord(_p)] = pst[ord(_p.lower())] = sunfish.pst[_p]
+    mvv_lva[ord(_p)] = mvv_lva[ord(_p.lower())] = sunfish.mvv_lva[_p]
+    qs_quiets[ord(_p)] = sunfish.qs_quiets[_p]
+for _p in sunfish.zobrist:
+    zobrist[ord(_p)] = sunfish.zobrist[_p]
+    zobrist_rotated[ord(_p)] = sunfish.zobrist_rotated[_p]
+
+
+###############################################################################
+# Chess logic
+###############################################################################
+
+class Board:
+    """ A chess game state with make/unmake
+    boards -- the two 120 byte views of the board, one per player
+    color -- index of the view of the player to move
+    pieces -- for each player, the set of squares of its pieces in its own view
+    score, wc, bc, ep, kp, key, rkey -- as in sunfish.Position
+    """
+
+    def __init__(self, pos):
+        rotated = pos.rotate()
+        self.boards = [bytearray(pos.board.encode('ascii')), bytearray(rotated.board.encode('ascii'))]
+        self.color = 0
+        self.pieces = [
+            set(i for i, p in enumerate(pos.board) if p.isupper()),
+            set(i for i, p in enumerate(rotated.board) if p.isupper())]
+        self.score, self.wc, self.bc, self.ep, self.kp = pos.score, pos.wc, pos.bc, pos.ep, pos.kp
+        self.key, self.rkey = pos.key, pos.rkey
+        self.stack = []
+
+    def position(self):
+        ''' The sunfish.Position equivalent to the current state '''
+        board = bytes(self.boards[self.color]).decode('ascii')
+        return sunfish.Position(board, self.score, self.wc, self.bc, self.ep, self.kp, self.key, self.rkey)
+
+    def has_officers(self):
+        b = self.boards[self.color]
+        return any(officer[b[i]] for i in self.pieces[self.color])
+
+    def gen_moves(self):
+        # Same moves, in the same order, as sunfish.Position.gen_moves. A list
+        # is returned since the board changes while the moves are searched.
+        b = self.boards[self.color]
+        wc, ep, kp = self.wc, self.ep, self.kp
+        moves = []
+        for i in sorted(self.pieces[self.color]):
+            p = b[i]
+            if p == PAWN:
+                if b[i+N] == EMPTY:
+                    moves.append((i, i+N))
+                    if i >= A1+N and b[i+N+N] == EMPTY: moves.append((i, i+N+N))
+                for j in (i+N+W, i+N+E):
+                    if islower[b[j]] or j in (ep, kp): moves.append((i, j))
+                continue
+            if jumper[p]:
+                for j in jumps[p][i]:
+                    if not isupper[b[j]]: moves.append((i, j))
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = b[j]
+                    if isupper[q]: break
+                    moves.append((i, j))
+                    if islower[q]: break
+                    # Castling, by sliding the rook next to the king
+                    if i == A1 and b[j+E] == KING and wc[0]: moves.append((j+E, j+W))
+                    if i == H1 and b[j+W] == KING and wc[1]: moves.append((j+W, j+E))
+        return moves
+
+    def gen_captures(self):
+        # Same as sunfish.Position.gen_captures
+        b = self.boards[self.color]
+        ep, kp = self.ep, self.kp
+        moves = []
+        for i in sorted(self.pieces[self.color]):
+            p = b[i]
+            big = qs_quiets[p][i]
+            if p == PAWN:
+                for j in (i+N+W, i+N+E):
+                    if islower[b[j]] or j in (ep, kp): moves.append((i, j))
+                if A8 <= i+N <= H8 and b[i+N] == EMPTY: moves.append((i, i+N))
+                if big and b[i+N] == EMPTY:
+                    if i+N in big: moves.append((i, i+N))
+                    if i+N+N in big and b[i+N+N] == EMPTY: moves.append((i, i+N+N))
+                continue
+            if jumper[p]:
+                for j in jumps[p][i]:
+                    if islower[b[j]] or b[j] == EMPTY and (abs(j-kp) < 2 or j in big):
+                        moves.append((i, j))
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    q = b[j]
+                    if q == EMPTY:
+                        if abs(j-kp) < 2 or j in big: moves.append((i, j))
+                        continue
+                    if islower[q]: moves.append((i, j))
+                    break
+        moves.sort(key=self.capture_order, reverse=True)
+        return moves
+
+    def capture_order(self, move):
+        i, j = move
+        b = self.boards[self.color]
+        p, q = b[i], b[j]
+        victim = mvv_lva[KING] if abs(j-self.kp) < 2 else mvv_lva[q]
+        if p == PAWN:
+            if j == self.ep: victim = mvv_lva[PAWN]
+            if A8 <= j <= H8: victim += mvv_lva[QUEEN] - mvv_lva[PAWN]
+        return 16*victim - mvv_lva[p]
+
+    def gen_quiets(self):
+        # Same as sunfish.Position.gen_quiets
+        b = self.boards[self.color]
+        wc, kp = self.wc, self.kp
+        moves = []
+        for i in sorted(self.pieces[self.color]):
+            p = b[i]
+            big = qs_quiets[p][i]
+            if p == PAWN:
+                if b[i+N] == EMPTY and not A8 <= i+N <= H8:
+                    if i+N not in big: moves.append((i, i+N))
+                    if i >= A1+N and b[i+N+N] == EMPTY and i+N+N not in big: moves.append((i, i+N+N))
+                continue
+            if jumper[p]:
+                for j in jumps[p][i]:
+                    if b[j] == EMPTY and abs(j-kp) >= 2 and j not in big: moves.append((i, j))
+                continue
+            for ray in rays[p][i]:
+                for j in ray:
+                    if b[j] != EMPTY: break
+                    if abs(j-kp) >= 2 and j not in big: moves.append((i, j))
+                    if i == A1 and b[j+E] == KING and wc[0]: moves.append((j+E, j+W))
+                    if i == H1 and b[j+W] == KING and wc[1]: moves.append((j+W, j+E))
+        return moves
+
+    def attacks(self, j):
+        # Same as sunfish.Position.attacks
+        b = self.boards[self.color]
+        if b[j+S+W] == PAWN or b[j+S+E] == PAWN:
+            return True
+        for p in (KNIGHT, KING):
+            for k in jumps[p][j]:
+                if b[k] == p: return True
+        for p in (ROOK, BISHOP):
+            for ray in rays[p][j]:
+                for k in ray:
+                    q = b[k]
+                    if q == EMPTY: continue
+                    if q == p or q == QUEEN: return True
+                    break
+        return False
+
+    def can_capture_king(self):
+        # Same as sunfish.Position.can_capture_king
+        if self.kp:
+            return any(self.value(m) >= MATE_LOWER for m in self.gen_moves())
+        k = self.boards[self.color].find(b'k')
+        return k != -1 and self.attacks(k)
+
+    def value(self, move):
+        i, j = move
+        b = self.boards[self.color]
+        p, q = b[i], b[j]
+        # Actual move
+        score = pst[p][j] - pst[p][i]
+        # Capture
+        if islower[q]:
+            score += pst[q][119-j]
+        # Castling check detection
+        if abs(j-self.kp) < 2:
+            score += pst[KING][119-j]
+        # Castling
+        if p == KING and abs(i-j) == 2:
+            score += pst[ROOK][(i+j)//2]
+            score -= pst[ROOK][A1 if j < i else H1]
+        # Special pawn stuff
+        if p == PAWN:
+            if A8 <= j <= H8:
+                score += pst[QUEEN][j] - pst[PAWN][j]
+            if j == self.ep:
+                score += pst[PAWN][119-(j+S)]
+        return score
+
+    def _set(self, i, p):
+        # Puts <p> on square <i> of the view of the player to move, keeping
+        # the other view and the piece lists in sync
+        c = self.color
+        b = self.boards[c]
+        q = b[i]
+        if isupper[q]: self.pieces[c].discard(i)
+        elif islower[q]: self.pieces[1-c].discard(119-i)
+        b[i] = p
+        self.boards[1-c][119-i] = swapcase[p]
+        if isupper[p]: self.pieces[c].add(i)
+        elif islower[p]: self.pieces[1-c].add(119-i)
+
+    def _put(self, i, p, undo):
+        q = self.boards[self.color][i]
+        undo.append((i, q))
+        self.key ^= zobrist[q][i] ^ zobrist[p][i]
+        self.rkey ^= zobrist_rotated[q][i] ^ zobrist_rotated[p][i]
+        self._set(i, p)
+
+    def make(self, move, value=None):
+        i, j = move
+        b = self.boards[self.color]
+        p, q = b[i], b[j]
+        undo = []
+        self.stack.append((self.score, self.wc, self.bc, self.ep, self.kp, self.key, self.rkey, undo))
+        k, rk = sunfish.zobrist_state(self.wc, self.bc, self.ep, self.kp)
+        self.key ^= k
+        self.rkey ^= rk
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        score = self.score + (self.value(move) if value is None else value)
+        # Actual move
+        self._put(j, p, undo)
+        self._put(i, EMPTY, undo)
+        # Castling rights, we move the rook or capture the opponent's
+        if i == A1: wc = (False, wc[1])
+        if i == H1: wc = (wc[0], False)
+        if j == A8: bc = (bc[0], False)
+        if j == H8: bc = (False, bc[1])
+        # Castling
+        if p == KING:
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                self._put(A1 if j < i else H1, EMPTY, undo)
+                self._put(kp, ROOK, undo)
+        # Pawn promotion, double move and en passant capture
+        if p == PAWN:
+            if A8 <= j <= H8:
+                self._put(j, QUEEN, undo)
+            if j - i == 2*N:
+                ep = i + N
+            if j - i in (N+W, N+E) and q == EMPTY:
+                self._put(j+S, EMPTY, undo)
+        k, rk = sunfish.zobrist_state(wc, bc, ep, kp)
+        # Hand the move over to the other player, like Position.rotate
+        self.color = 1 - self.color
+        self.score = -score
+        self.wc, self.bc = bc, wc
+        self.ep = 119-ep if ep else 0
+        self.kp = 119-kp if kp else 0
+        self.key, self.rkey = self.rkey ^ rk, self.key ^ k
+
+    def nullmove(self):
+        ''' Like Position.nullmove, to be reverted with unmake '''
+        self.stack.append((self.score, self.wc, self.bc, self.ep, self.kp, self.key, self.rkey, []))
+        key, rkey = self.key, self.rkey
+        if self.ep or self.kp:
+            k, rk = sunfish.zobrist_state(self.wc, self.bc, self.ep, self.kp)
+            k0, rk0 = sunfish.zobrist_rights[self.wc, self.bc]
+            key, rkey = key ^ k ^ k0, rkey ^ rk ^ rk0
+        self.color = 1 - self.color
+        self.score = -self.score
+        self.wc, self.bc = self.bc, self.wc
+        self.ep = self.kp = 0
+        self.key, self.rkey = rkey, key
+
+    def unmake(self):
+        self.color = 1 - self.color
+        self.score, self.wc, self.bc, self.ep, self.kp, self.key, self.rkey, undo = self.stack.pop()
+        for i, p in reversed(undo):
+            self._set(i, p)
+
+
+###############################################################################
+# Search logic
+###############################################################################
+
+class Searcher(sunfish.Searcher):
+    ''' sunfish.Searcher running on a Board instead of Position objects '''
+
+    def _position(self, pos):
+        return Board(pos)
+
+    def bound(self, board, gamma, depth, root=True):
+        """ returns r where
+                s(pos) <= r < gamma    if gamma > s(pos)
+                gamma <= r <= s(pos)   if gamma <= s(pos)"""
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and self.out_of_time():
+            raise sunfish.TimeUp()
+
+        # See sunfish.Searcher.bound for comments on the search itself, this
+        # is the same algorithm with make/unmake in place of Position.move.
+        depth = max(depth, 0)
+
+        if board.score <= -MATE_LOWER:
+            return -MATE_UPPER
+
+        if not root and self.tablebase is not None and board.boards[board.color].count(b'.') >= 61:
+            score = self.tablebase.probe(board.key, board.boards[board.color].decode('ascii'))
+            if score is not None:
+                return score
+
+        entry = self.tp_score.get((board.key, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
+        if entry.lower >= gamma and (not root or self.tp_move.get(board.key) is not None):
+            return entry.lower
+        if entry.upper < gamma:
+            return entry.upper
+
+        def search(move, gamma, depth, value=None):
+            if move is None:
+                board.nullmove()
+            else:
+                board.make(move, value)
+            score = -self.bound(board, gamma, depth, root=False)
+            board.unmake()
+            return score
+
+        def moves():
+            # First try not moving at all
+            if depth > 0 and not root and board.has_officers():
+                yield None, search(None, 1-gamma, depth-3)
+            # For QSearch we have a different kind of null-move
+            if depth == 0:
+                yield None, board.score
+            # Then killer move
+            killer = self.tp_move.get(board.key)
+            if killer:
+                value = board.value(killer)
+                if depth > 0 or value >= QS_LIMIT:
+                    yield killer, search(killer, 1-gamma, depth-1, value)
+            # Then captures, the only moves QSearch looks at
+            for move in board.gen_captures():
+                if move == killer: continue
+                value = board.value(move)
+                if depth > 0 or value >= QS_LIMIT:
+                    yield move, search(move, 1-gamma, depth-1, value)
+            # Then the quiet moves, only generated if nothing above cut off
+            if depth > 0:
+                for value, move in sorted(((board.value(m), m) for m in board.gen_quiets()), reverse=True):
+                    if move == killer: continue
+                    yield move, search(move, 1-gamma, depth-1, value)
+
+        best = -MATE_UPPER
+        for move, score in moves():
+            best = max(best, score)
+            if best >= gamma:
+                self.tp_move.put(board.key, move, depth)
+                break
+
+        # Stalemate checking
+        if best < gamma and best < 0 and depth > 0:
+            def is_dead_after(move):
+                if move is None:
+                    board.nullmove()
+                else:
+                    board.make(move)
+                dead = board.can_capture_king()
+                board.unmake()
+                return dead
+            if all(is_dead_after(m) for m in board.gen_moves()):
+                in_check = is_dead_after(None)
+                best = -MATE_UPPER if in_check else 0
+
+        if best >= gamma:
+            self.tp_score.put((board.key, depth, root), Entry(best, entry.upper), depth)
+        if best < gamma:
+            self.tp_score.put((board.key, depth, root), Entry(entry.lower, best), depth)
+
+        return best
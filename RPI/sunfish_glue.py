@@ -1,6 +1,10 @@
 # This module provides various methods to convert between our own data format and
 # representation style for moves and matrix, to the Sunfish algorithm one
 
+import re
+import operator
+import sunfish
+
 translateRules = [
     ('T', 'R'),
     ('C', 'N'),
@@ -10,48 +14,233 @@ translateRules = [
     (' ', '.')
 ]
 
+try:
+    maketrans = str.maketrans
+except AttributeError:
+    from string import maketrans
+
+# Our pieces to the sunfish ones, as a table for str.translate
+luneburgToSunfishPieces = maketrans(
+    ''.join(r[0] + r[0].lower() for r in translateRules),
+    ''.join(r[1] + r[1].lower() for r in translateRules))
+
+# The sunfish square of each cell (x, y) of ours, graveyards included, and the
+# cell of each square of a sunfish board seen from white, or rotated as when
+# black is to move. The x of our cells goes from the h file to the a file.
+luneburgSquares = dict(((x, y), 98 - x - 10 * y) for x in range(-2, 10) for y in range(8))
+sunfishCells = [None] * 120
+sunfishRotatedCells = [None] * 120
+for (x, y), i in luneburgSquares.items():
+    if 0 <= x < 8:
+        sunfishCells[i] = (x, y)
+        sunfishRotatedCells[119 - i] = (x, y)
+
+# Picks the characters of a sunfish board out of our 64 cells, in the order of
+# the X command (x then y), followed by a space and a newline for the padding
+def boardLayout(cells):
+    layout = []
+    for i in range(120):
+        if cells[i] is not None:
+            layout.append(8 * cells[i][0] + cells[i][1])
+        else:
+            layout.append(65 if i % 10 == 9 else 64)
+    return operator.itemgetter(*layout)
+
+boardFromCells = boardLayout(sunfishCells)
+rotatedBoardFromCells = boardLayout(sunfishRotatedCells)
+
+# Turns our pieces in <cells> into the sunfish ones. The cells read from the
+# board are unicode, which Python 2 can't translate with the table above, so
+# they are made a native string first, characters that aren't ascii becoming '?'
+def sunfishPieces(cells):
+    if not isinstance(cells, str):
+        cells = cells.encode('ascii', 'replace')
+    return cells.translate(luneburgToSunfishPieces)
+
+# Builds the sunfish board, seen from white, of our 64 cells in the order of
+# the X command, like BoardModel.content() returns them
+def luneburgCellsToSunfishBoard(cells):
+    return ''.join(boardFromCells(sunfishPieces(cells) + ' \n'))
+
+# Builds the sunfish board, seen from white, of a matrix[x][y] of our own
+def luneburgToSunfishBoard(matrix):
+    return luneburgCellsToSunfishBoard(''.join(''.join(column) for column in matrix))
+
+# Lays the pieces of a matrix[x][y] of our own out in 12 rows of 10 characters,
+# as in a sunfish board seen from black but keeping the colours of the pieces
 def luneburgToSunfishMatrix(matrix):
-    output = []
-    for i in range(12):
-        output.append([])
-        for j in range(10):
-            output[i].append(' ')
-        output[i][9] = '\n'
-    for y in range(8):
-        for x in range(8):
-            waslower = matrix[x][y].islower()
-            translated = matrix[x][y]
-            for r in translateRules:
-                if r[0].lower() == matrix[x][y].lower():
-                    translated = r[1]
-                    if waslower == True:
-                        translated = translated.lower()
-                    else:
-                        translated = translated.upper()
-                    break
-            output[y + 2][x + 1] = translated
-    return output
+    cells = ''.join(''.join(column) for column in matrix)
+    board = ''.join(rotatedBoardFromCells(sunfishPieces(cells) + ' \n'))
+    return [list(board[k:k + 10]) for k in range(0, 120, 10)]
 
 def sunfishToLuneburgMove(move):
-    sy, sx = divmod((119 - move[0]) - 91, 10)
-    sy = 7 - (-sy)
-    dy, dx = divmod((119 - move[1]) - 91, 10)
-    dy = 7 - (-dy)
-    return (sx, sy, dx, dy)
+    return sunfishCells[move[0]] + sunfishCells[move[1]]
 
 def luneburgToSunfishMove(move):
-    s = 119 - ((move[0] + (move[1] - 7) * 10) + 91)
-    d = 119 - ((move[2] + (move[3] - 7) * 10) + 91)
-    return (s, d)
+    return (luneburgSquares[move[0], move[1]], luneburgSquares[move[2], move[3]])
 
 def sunfishToLuneburgRotatedMove(move):
-    move = sunfishToLuneburgMove(move)
-    return (
-        7 - move[0],
-        7 - move[1],
-        7 - move[2],
-        7 - move[3]
-    )
+    return sunfishRotatedCells[move[0]] + sunfishRotatedCells[move[1]]
+
+# Builds the sunfish.Position described by a FEN string. As sunfish always
+# plays white, when black is to move the position is returned rotated.
+# The move counters, if present, are ignored.
+def fenToSunfishPosition(fen):
+    board, color, castling, enpas = fen.split()[:4]
+    board = re.sub(r'\d', lambda m: '.' * int(m.group(0)), board)
+    board = list(21 * ' ' + '  '.join(board.split('/')) + 21 * ' ')
+    board[9::10] = ['\n'] * 12
+    board = ''.join(board)
+    wc = ('Q' in castling, 'K' in castling)
+    bc = ('k' in castling, 'q' in castling)
+    ep = sunfish.parse(enpas) if enpas != '-' else 0
+    pos = sunfish.Position(board, sunfishBoardScore(board), wc, bc, ep, 0)
+    if color == 'b':
+        return pos.rotate()
+    return pos
+
+# Writes the FEN string of a sunfish.Position, the opposite of
+# fenToSunfishPosition. <black> tells whether <pos> is rotated, black being to
+# move. Sunfish doesn't count the moves, so the counters are given.
+def sunfishPositionToFen(pos, black=False, halfmove=0, fullmove=1):
+    if black:
+        pos = pos.rotate()
+    rows = [pos.board[k + 1:k + 9] for k in range(20, 100, 10)]
+    board = re.sub(r'\.+', lambda m: str(len(m.group(0))), '/'.join(rows))
+    castling = ''.join(c for c, right in zip('KQkq', pos.wc[::-1] + pos.bc) if right) or '-'
+    enpas = squareNames[pos.ep] if pos.ep else '-'
+    return ' '.join((board, 'b' if black else 'w', castling, enpas, str(halfmove), str(fullmove)))
+
+# The score of a sunfish board from scratch, as sunfish.Position keeps it
+def sunfishBoardScore(board):
+    score = sum(sunfish.pst[p][i] for i, p in enumerate(board) if p.isupper())
+    score -= sum(sunfish.pst[p.upper()][119 - i] for i, p in enumerate(board) if p.islower())
+    return score
+
+# The indexes of the 64 squares of a sunfish board
+boardSquares = [i for i in range(120) if sunfishCells[i] is not None]
+
+# The squares where the sunfish boards <a> and <b> hold different pieces
+def diffSunfishBoards(a, b):
+    if a == b:
+        return []
+    return [i for i in boardSquares if a[i] != b[i]]
+
+# Finds the shortest sequence of legal moves, of at most <maxPlies>, taking
+# <pos> to the pieces of <board>, which is seen from white. <black> tells
+# whether <pos> is rotated. When <parity> is given, only sequences of an odd
+# (1) or even (0) length are accepted, so that the right side ends up to move.
+# Returns the moves, to be played one after the other on <pos>, or None.
+# Every move must start or end on a square still differing from the board,
+# which leaves out the sequences wasting moves on the way.
+def explainSunfishBoard(pos, board, black=False, maxPlies=3, parity=None):
+    # The board from the side to move, then from the other one
+    targets = [board, board[::-1].swapcase()]
+    if black:
+        targets.reverse()
+
+    # Sequences of exactly <plies> moves
+    def search(pos, plies, side):
+        diff = diffSunfishBoards(pos.board, targets[side])
+        if plies == 0:
+            return [] if not diff else None
+        # A move changes at most four squares, castling
+        if len(diff) > 4 * plies:
+            return None
+        for move in pos.gen_moves():
+            if move[0] not in diff and move[1] not in diff:
+                continue
+            after = pos.move(move)
+            if after.can_capture_king():
+                continue
+            found = search(after, plies - 1, 1 - side)
+            if found is not None:
+                return [move] + found
+        return None
+
+    for plies in range(maxPlies + 1):
+        if parity is None or plies % 2 == parity:
+            found = search(pos, plies, 0)
+            if found is not None:
+                return found
+    return None
+
+# Builds the position of a sunfish <board> seen from white, for when no moves
+# explain it. The castling rights of <pos>, also seen from white, are kept as
+# long as the king and the rook are still on their squares, and en passant is
+# lost. Like fenToSunfishPosition, the position is rotated if <black> is to move.
+def sunfishBoardToPosition(board, black=False, pos=None):
+    wc, bc = (pos.wc, pos.bc) if pos is not None else ((True, True), (True, True))
+    e1, e8 = sunfish.parse('e1'), sunfish.parse('e8')
+    wc = (wc[0] and board[e1] == 'K' and board[sunfish.A1] == 'R',
+          wc[1] and board[e1] == 'K' and board[sunfish.H1] == 'R')
+    bc = (bc[0] and board[e8] == 'k' and board[sunfish.H8] == 'r',
+          bc[1] and board[e8] == 'k' and board[sunfish.A8] == 'r')
+    pos = sunfish.Position(board, sunfishBoardScore(board), wc, bc, 0, 0)
+    if black:
+        return pos.rotate()
+    return pos
+
+# The names of the squares of a sunfish board seen from white, and of the
+# rotated one, and the other way round
+squareNames = [sunfish.render(i) if sunfishCells[i] is not None else None for i in range(120)]
+rotatedSquareNames = squareNames[::-1]
+squareIndexes = dict((name, i) for i, name in enumerate(squareNames) if name is not None)
+rotatedSquareIndexes = dict((name, i) for i, name in enumerate(rotatedSquareNames) if name is not None)
+
+# Renders a sunfish move in coordinate notation, like "b1c3". Moves of
+# positions with black to move are rotated like the positions themselves.
+def sunfishToCoordinateMove(move, black=False):
+    names = rotatedSquareNames if black else squareNames
+    return names[move[0]] + names[move[1]]
+
+# Parses a move in coordinate notation, the opposite of sunfishToCoordinateMove.
+# A trailing promotion piece is accepted, sunfish always promoting to a queen.
+def coordinateToSunfishMove(text, black=False):
+    indexes = rotatedSquareIndexes if black else squareIndexes
+    return (indexes[text[0:2]], indexes[text[2:4]])
+
+# The moves of <pos> that don't leave the king to be captured
+def legalSunfishMoves(pos):
+    return [m for m in pos.gen_moves() if not pos.move(m).can_capture_king()]
+
+# Renders a legal move of <pos> in standard algebraic notation, like "Nxe5",
+# without the check and mate marks. <black> tells whether <pos> is rotated.
+def sunfishToSanMove(pos, move, black=False):
+    i, j = move
+    p = pos.board[i]
+    coord = sunfishToCoordinateMove(move, black)
+    capture = pos.board[j].islower() or (p == 'P' and j == pos.ep)
+    if p == 'K' and abs(j - i) == 2:
+        return 'O-O' if coord[2] == 'g' else 'O-O-O'
+    if p == 'P':
+        san = (coord[0] + 'x' if capture else '') + coord[2:4]
+        if sunfish.A8 <= j <= sunfish.H8:
+            san += '=Q'
+        return san
+    # Other pieces of the same kind that can reach the same square
+    others = [sunfishToCoordinateMove(m, black)[0:2] for m in legalSunfishMoves(pos)
+        if m[1] == j and m[0] != i and pos.board[m[0]] == p]
+    if not others:
+        origin = ''
+    elif all(o[0] != coord[0] for o in others):
+        origin = coord[0]
+    elif all(o[1] != coord[1] for o in others):
+        origin = coord[1]
+    else:
+        origin = coord[0:2]
+    return p + origin + ('x' if capture else '') + coord[2:4]
+
+# Finds the legal move of <pos> written <san> in standard algebraic notation.
+# Returns None if there is no such move, like for underpromotions.
+def sanToSunfishMove(pos, san, black=False):
+    san = san.rstrip('+#!?').replace('0', 'O')
+    if re.match(r'^[a-h][1-8]=?Q$|^[a-h]x[a-h][1-8]=?Q$', san) and '=' not in san:
+        san = san[:-1] + '=Q'
+    for move in legalSunfishMoves(pos):
+        if sunfishToSanMove(pos, move, black) == san:
+            return move
+    return None
 
 # If this module is run standalone as a script, some tests are carried out
 if __name__ == "__main__":
@@ -83,5 +272,38 @@ if __name__ == "__main__":
     test("l2s_move_2", luneburgToSunfishMove((6, 0, 5, 2)), (92, 73))
     test("s2l_rot_move_1", sunfishToLuneburgRotatedMove((92, 73)), (1, 7, 2, 5))
     test("s2l_rot_move_2", sunfishToLuneburgRotatedMove((84, 64)), (3, 6, 3, 4))
+    initial = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+    test("fen_initial", fenToSunfishPosition("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"), initial)
+    test("fen_black", fenToSunfishPosition("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"),
+        initial.move((sunfish.parse('e2'), sunfish.parse('e4'))))
+    test("coord_move", sunfishToCoordinateMove((92, 73)), "b1c3")
+    test("coord_rot_move", sunfishToCoordinateMove((92, 73), True), "g8f6")
+    test("coord_parse", coordinateToSunfishMove("g8f6", True), (92, 73))
+    test("san_knight", sunfishToSanMove(initial, (92, 73)), "Nc3")
+    test("san_parse", sanToSunfishMove(initial, "e4"), (85, 65))
+    rooks = fenToSunfishPosition("4k3/8/8/8/8/8/8/R4RK1 w - - 0 1")
+    test("san_disambiguate", sunfishToSanMove(rooks, (91, 94)), "Rad1")
+    castle = fenToSunfishPosition("4k3/8/8/8/8/8/8/R3K2R w KQ - 0 1")
+    test("san_castle", sanToSunfishMove(castle, "O-O+"), (95, 97))
+    test("san_promote", sanToSunfishMove(fenToSunfishPosition("8/4P3/8/8/8/8/k7/4K3 w - - 0 1"), "e8Q"), (35, 25))
+    black = fenToSunfishPosition("r3k3/8/8/8/8/8/8/4K3 b q - 0 1")
+    test("san_black_castle", sunfishToCoordinateMove(sanToSunfishMove(black, "O-O-O"), True), "e8c8")
+
+    start = [firstRow + 'P' + ' ' * 4 + 'p' + firstRow.lower() for firstRow in "TCARGACT"]
+    test("board_initial", luneburgToSunfishBoard(start), sunfish.initial)
+    test("matrix_initial", ''.join(luneburgToSunfishMatrix(start)[9]), " rnbkqbnr\n")
+    # Unicode cells, as decoded from the MATRIX events
+    read = bytearray(''.join(start).encode('ascii')).decode('ascii', 'replace')
+    test("cells_unicode", luneburgCellsToSunfishBoard(read), sunfish.initial)
+    test("board_unicode", luneburgToSunfishBoard([read[x * 8:x * 8 + 8] for x in range(8)]), sunfish.initial)
+    test("matrix_unicode", ''.join(luneburgToSunfishMatrix(list(read[x * 8:x * 8 + 8]) for x in range(8))[9]), " rnbkqbnr\n")
+    test("fen_export", sunfishPositionToFen(initial.move((85, 65)), True), "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1")
+    e4 = initial.move((85, 65))
+    test("explain_move", explainSunfishBoard(initial, e4.rotate().board), [(85, 65)])
+    test("explain_black", explainSunfishBoard(e4, e4.move((85, 65)).board, True), [(85, 65)])
+    test("explain_none", explainSunfishBoard(initial, initial.board, parity=1), None)
+    test("board_position", sunfishBoardToPosition(initial.board), initial)
+    moved = sunfishBoardToPosition(initial.board[:85] + 'K' + initial.board[86:95] + '.' + initial.board[96:], pos=initial)
+    test("board_castling", (moved.wc, moved.bc), ((False, False), (True, True)))
 
     printSummary();
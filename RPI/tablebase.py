@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Endgame tables for a king and a queen, rook or pawn against a lone king.
+#
+# The tables are built offline by retrograde analysis and saved to a file:
+#
+#   python tablebase.py build endgames.bin
+#
+# Each table holds one byte per position, indexed by the side to move and
+# the squares of the strong king, the weak king and the piece:
+#
+#   index = side << 18 | strong_king << 12 | weak_king << 6 | piece
+#
+# with squares numbered from a1 = 0 to h8 = 63, as seen by the strong side,
+# and side 0 when the strong side is to move. A byte is ILLEGAL for positions
+# that can't occur, DRAW for draws and otherwise the distance to mate in
+# plies plus one. The strong side can only win and the weak side only lose.
+#
+# Sunfish only promotes to queens, so the pawn table does too: a few
+# positions that only an underpromotion wins are draws in it.
+#
+# The file starts with a header naming the tables and where they are, and is
+# memory-mapped, so only the probed pages are ever read.
+
+from __future__ import print_function
+import sys, mmap, time, struct, argparse
+from collections import OrderedDict
+import sunfish
+
+MAGIC = b'SFTB'
+HEADER = struct.Struct('<4sI')
+ENTRY = struct.Struct('<4sII')
+
+DRAW, ILLEGAL = 0, 255
+TABLES = ('KQK', 'KRK', 'KPK')
+SIZE = 2 << 18
+
+###############################################################################
+# Geometry
+###############################################################################
+
+def _square(f, r):
+    return r * 8 + f if 0 <= f < 8 and 0 <= r < 8 else None
+
+_kings = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+_rooks = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+_bishops = [(1, 1), (-1, 1), (-1, -1), (1, -1)]
+
+king_moves = [[t for t in (_square(s % 8 + df, s // 8 + dr) for df, dr in _kings) if t is not None]
+              for s in range(64)]
+adjacent = [[max(abs(s % 8 - t % 8), abs(s // 8 - t // 8)) <= 1 for t in range(64)] for s in range(64)]
+
+def _rays(s, directions):
+    rays = []
+    for df, dr in directions:
+        ray, t = [], _square(s % 8 + df, s // 8 + dr)
+        while t is not None:
+            ray.append(t)
+            t = _square(t % 8 + df, t // 8 + dr)
+        rays.append(ray)
+    return rays
+
+rays = {'Q': [_rays(s, _rooks + _bishops) for s in range(64)],
+        'R': [_rays(s, _rooks) for s in range(64)]}
+
+def _attacks(piece, s, blocker):
+    ''' Bit mask of the squares attacked by a strong piece on s, the strong
+    king being on blocker '''
+    if piece == 'P':
+        return sum(1 << t for t in (_square(s % 8 - 1, s // 8 + 1), _square(s % 8 + 1, s // 8 + 1)) if t is not None)
+    mask = 0
+    for ray in rays[piece][s]:
+        for t in ray:
+            mask |= 1 << t
+            if t == blocker:
+                break
+    return mask
+
+# The weak king never blocks the piece in any of the questions asked, as it is
+# either the target or the king moving, so the strong king is the only blocker.
+attacks = {p: [_attacks(p, s, b) for s in range(64) for b in range(64)] for p in 'QRP'}
+
+###############################################################################
+# Generation
+###############################################################################
+
+def _legal(piece, side, sk, wk, x):
+    if sk == wk or x == sk or x == wk or adjacent[sk][wk]:
+        return False
+    if piece == 'P' and not 8 <= x < 56:
+        return False
+    # With the strong side to move, the weak king can't be in check
+    return side == 1 or not attacks[piece][x * 64 + sk] >> wk & 1
+
+def _strong_moves(piece, sk, wk, x):
+    ''' Squares (sk, x) after each move of the strong side, and whether the
+    move is a promotion '''
+    for t in king_moves[sk]:
+        if t != x and not adjacent[t][wk]:
+            yield t, x, False
+    if piece == 'P':
+        t = x + 8
+        if t != sk and t != wk:
+            yield sk, t, t >= 56
+            if x < 16 and t + 8 != sk and t + 8 != wk:
+                yield sk, t + 8, False
+        return
+    for ray in rays[piece][x]:
+        for t in ray:
+            if t == sk or t == wk:
+                break
+            yield sk, t, False
+
+def _weak_moves(piece, sk, wk, x):
+    ''' Squares of the weak king after each of its moves, capturing included '''
+    attacked = attacks[piece][x * 64 + sk]
+    for t in king_moves[wk]:
+        if adjacent[t][sk]:
+            continue
+        if t == x or not attacked >> t & 1:
+            yield t
+
+def _strong_unmoves(piece, sk, wk, x):
+    ''' Squares (sk, x) before each move of the strong side '''
+    for f in king_moves[sk]:
+        if f != x and f != wk and not adjacent[f][wk]:
+            yield f, x
+    if piece == 'P':
+        f = x - 8
+        if f >= 8 and f != sk and f != wk:
+            yield sk, f
+            if 24 <= x < 32 and f - 8 != sk and f - 8 != wk:
+                yield sk, f - 8
+        return
+    for ray in rays[piece][x]:
+        for f in ray:
+            if f == sk or f == wk:
+                break
+            yield sk, f
+
+def generate(piece, queens=None):
+    ''' Table for a king and piece against a king. The pawn table needs the
+    queen table, to know the value of the positions after promotions. '''
+    table = bytearray([ILLEGAL]) * SIZE
+    counts = [0] * SIZE
+    buckets = [[] for _ in range(256)]
+    for sk in range(64):
+        for wk in range(64):
+            for x in range(64):
+                for side in (0, 1):
+                    if not _legal(piece, side, sk, wk, x):
+                        continue
+                    i = side << 18 | sk << 12 | wk << 6 | x
+                    table[i] = DRAW
+                    if side == 1:
+                        counts[i] = sum(1 for _ in _weak_moves(piece, sk, wk, x))
+                        # Mated
+                        if counts[i] == 0 and attacks[piece][x * 64 + sk] >> wk & 1:
+                            buckets[0].append(i)
+                    elif piece == 'P' and x >= 48:
+                        # Promotions leave the table for the queen one
+                        for k, t, promotion in _strong_moves(piece, sk, wk, x):
+                            value = queens[1 << 18 | sk << 12 | wk << 6 | t] if promotion else DRAW
+                            if value not in (DRAW, ILLEGAL):
+                                buckets[value].append(i)
+    # Positions are resolved by increasing distance to mate, so the strong
+    # side gets the shortest win and the weak side the longest defence.
+    for plies in range(255):
+        for i in buckets[plies]:
+            if table[i] != DRAW:
+                continue
+            table[i] = plies + 1
+            sk, wk, x = i >> 12 & 63, i >> 6 & 63, i & 63
+            if i >> 18:
+                # The weak side loses here, so it won before the strong move
+                for f, y in _strong_unmoves(piece, sk, wk, x):
+                    j = f << 12 | wk << 6 | y
+                    if table[j] == DRAW:
+                        buckets[plies + 1].append(j)
+            else:
+                # The strong side wins here, leaving one less escape to the
+                # weak side before its move
+                for f in king_moves[wk]:
+                    j = 1 << 18 | sk << 12 | f << 6 | x
+                    if table[j] == DRAW and f != x and not adjacent[f][sk]:
+                        counts[j] -= 1
+                        if counts[j] == 0:
+                            buckets[plies + 1].append(j)
+    return table
+
+def build(path):
+    tables = {}
+    for name in TABLES:
+        start = time.time()
+        tables[name] = generate(name[1], tables.get('KQK'))
+        t = tables[name]
+        wins = sum(1 for i in range(SIZE >> 1) if t[i] not in (DRAW, ILLEGAL))
+        legal = sum(1 for i in range(SIZE >> 1) if t[i] != ILLEGAL)
+        longest = max(v for v in t if v != ILLEGAL) - 1
+        print('%s: %d of %d positions won with the strong side to move, '
+              'longest mate in %d plies, %.1fs' % (name, wins, legal, longest, time.time() - start))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(TABLES)))
+        offset = HEADER.size + ENTRY.size * len(TABLES)
+        for name in TABLES:
+            f.write(ENTRY.pack(name.encode('ascii').ljust(4, b'\0'), offset, SIZE))
+            offset += SIZE
+        for name in TABLES:
+            f.write(tables[name])
+
+###############################################################################
+# Probing
+###############################################################################
+
+def _sq(i):
+    ''' Our square number of a sunfish board index '''
+    return (9 - i // 10) * 8 + i % 10 - 1
+
+class Tablebase:
+    ''' Read only view of a tablebase file, with a cache of the last probes '''
+    def __init__(self, path, cache_size=4096):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a tablebase file' % path)
+        self.offsets = {}
+        for n in range(count):
+            name, offset, size = ENTRY.unpack_from(self.map, HEADER.size + n * ENTRY.size)
+            self.offsets[name.rstrip(b'\0').decode('ascii')] = offset
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def probe(self, key, board):
+        ''' Score of a board, from the point of view of the side to move, or
+        None if the material isn't covered or the position is illegal. The key
+        is the Zobrist key of the position, used for the cache. '''
+        try:
+            score = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            score = self._probe(board)
+            self.misses += 1
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[key] = score
+        return score
+
+    def _probe(self, board):
+        pieces = [(i, p) for i, p in enumerate(board) if p.isalpha()]
+        if len(pieces) != 3:
+            return None
+        kinds = ''.join(sorted(p for i, p in pieces))
+        if kinds == 'KQk' or kinds == 'KRk' or kinds == 'KPk':
+            strong = True
+        elif kinds == 'Kkq' or kinds == 'Kkr' or kinds == 'Kkp':
+            strong = False
+        else:
+            return None
+        offset = self.offsets.get('K%sK' % ''.join(p for i, p in pieces if p not in 'Kk').upper())
+        if offset is None:
+            return None
+        # The table sees the board from the strong side, which for the weak
+        # side to move means rotating it
+        squares = dict((p, i if strong else 119 - i) for i, p in pieces)
+        sk = _sq(squares.pop('K' if strong else 'k'))
+        wk = _sq(squares.pop('k' if strong else 'K'))
+        x = _sq(squares.popitem()[1])
+        value = struct.unpack_from('B', self.map, offset + ((0 if strong else 1) << 18 | sk << 12 | wk << 6 | x))[0]
+        if value == ILLEGAL:
+            return None
+        if value == DRAW:
+            return 0
+        # Any mate scores above the other scores, sooner ones higher
+        score = sunfish.MATE_UPPER - value
+        return score if strong else -score
+
+    def best_move(self, pos):
+        ''' Move of a Position covered by the tables keeping the best result, by
+        the shortest way for the winner and the longest for the loser, with its
+        score, or None if pos isn't covered or has no legal moves '''
+        if self.probe(pos.key, pos.board) is None:
+            return None
+        best = None
+        for move in pos.gen_moves():
+            child = pos.move(move)
+            if child.can_capture_king():
+                continue
+            if child.board.count('.') == 62:
+                # Only the kings are left
+                score = 0
+            else:
+                score = self.probe(child.key, child.board)
+                if score is None:
+                    continue
+                score = -score
+            if best is None or score > best[1]:
+                best = move, score
+        return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or probe the endgame tables')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('build', help='generate the tables').add_argument('path')
+    probe = sub.add_parser('probe', help='look up a position')
+    probe.add_argument('path')
+    probe.add_argument('fen')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.path)
+    elif args.command == 'probe':
+        import sunfish_glue
+        tb = Tablebase(args.path)
+        pos = sunfish_glue.fenToSunfishPosition(args.fen)
+        black = args.fen.split()[1] == 'b'
+        print('score', tb.probe(pos.key, pos.board))
+        best = tb.best_move(pos)
+        if best is not None:
+            print('best', sunfish_glue.sunfishToSanMove(pos, best[0], black), best[1])
+        tb.close()
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Headless self-play. Each engine configuration plays a match against the
+# first one, the baseline, over openings taken from a move list file, each
+# opening being played once with each colour. Games run in a pool of worker
+# processes, and the score, Elo difference and nodes per second of each
+# configuration are reported at the end:
+#
+#   python tournament.py sunfish sunfish_board:5+0.05 --games 200 --tc 10+0.1
+#
+# A configuration is an engine module, optionally followed by its own time
+# control, either base+increment seconds on a clock or a fixed number of
+# seconds per move like 0.5s. Games are adjudicated as draws after too many
+# plies, on threefold repetition or under the fifty move rule, as wins when
+# both engines agree on a decisive score for several moves, and as draws when
+# they agree the position is dead even late in the game.
+
+from __future__ import print_function
+import sys, math, time, argparse, itertools, multiprocessing
+from collections import defaultdict
+import sunfish
+import sunfish_glue
+import book
+
+def parse_time_control(text):
+    ''' ('move', secs) for 'Ns', ('clock', base, increment) for 'base+inc' '''
+    if text.endswith('s'):
+        return ('move', float(text[:-1]))
+    base, _, increment = text.partition('+')
+    return ('clock', float(base), float(increment or 0))
+
+def parse_config(text, default_tc):
+    engine, _, tc = text.partition(':')
+    return {'name': text, 'engine': engine, 'tc': parse_time_control(tc or default_tc)}
+
+###############################################################################
+# Playing
+###############################################################################
+
+class Player:
+    ''' An engine configuration in a game, with its clock '''
+    def __init__(self, config, table_bytes):
+        self.searcher = __import__(config['engine']).Searcher(table_bytes)
+        self.tc = config['tc']
+        self.clock = self.tc[1] if self.tc[0] == 'clock' else None
+        self.nodes = 0
+        self.secs = 0.
+
+    def move(self, pos):
+        ''' Searches pos, returning the move, its score and whether the player
+        ran out of time '''
+        if self.clock is None:
+            limits = sunfish.move_time(self.tc[1])
+        else:
+            limits = sunfish.clock_time(self.clock, self.tc[2])
+        start = time.time()
+        move, score = self.searcher.search(pos, limits=limits)
+        elapsed = time.time() - start
+        self.nodes += self.searcher.nodes
+        self.secs += elapsed
+        if self.clock is not None:
+            self.clock += self.tc[2] - elapsed
+            if self.clock < 0:
+                return move, score, True
+        return move, score, False
+
+def play_game(args):
+    ''' Plays a game from the opening, returning its result, from white's
+    point of view, and the nodes and time of each side '''
+    number, white, black, opening, options = args
+    players = [Player(white, options['table_bytes']), Player(black, options['table_bytes'])]
+    pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+    for ply, text in enumerate(opening):
+        pos = pos.move(book.read_move(pos, text, ply % 2 == 1))
+    ply = len(opening)
+    seen = defaultdict(int)
+    quiet = 0
+    # Scores of the last moves, from white's point of view
+    scores = []
+    window = 2 * options['adjudicate_moves']
+    while True:
+        side = ply % 2
+        seen[pos.key] += 1
+        if not sunfish_glue.legalSunfishMoves(pos):
+            if pos.nullmove().can_capture_king():
+                result, reason = (0 if side == 0 else 1), 'checkmate'
+            else:
+                result, reason = .5, 'stalemate'
+            break
+        if seen[pos.key] >= 3:
+            result, reason = .5, 'repetition'
+            break
+        if quiet >= 100:
+            result, reason = .5, 'fifty moves'
+            break
+        if ply >= options['max_plies']:
+            result, reason = .5, 'length'
+            break
+        if len(scores) >= window:
+            last = scores[-window:]
+            if min(last) >= options['win_score'] or max(last) <= -options['win_score']:
+                result, reason = (1 if last[-1] > 0 else 0), 'adjudicated'
+                break
+            if ply >= options['draw_ply'] and max(abs(s) for s in last) <= options['draw_score']:
+                result, reason = .5, 'adjudicated'
+                break
+        move, score, flagged = players[side].move(pos)
+        if flagged:
+            result, reason = (0 if side == 0 else 1), 'time'
+            break
+        scores.append(-score if side else score)
+        capture = pos.board[move[1]].islower()
+        quiet = 0 if capture or pos.board[move[0]] == 'P' else quiet + 1
+        pos = pos.move(move)
+        ply += 1
+    return {'game': number, 'white': white['name'], 'black': black['name'],
+            'result': result, 'reason': reason, 'plies': ply,
+            'nodes': [p.nodes for p in players], 'secs': [p.secs for p in players]}
+
+###############################################################################
+# Statistics
+###############################################################################
+
+def elo(score):
+    return 400 * math.log10(score / (1 - score))
+
+def elo_difference(wins, draws, losses):
+    ''' Elo difference with its 95% confidence interval, from the results of
+    a match, or None when there are no games '''
+    games = wins + draws + losses
+    if not games:
+        return None
+    score = (wins + draws / 2.) / games
+    deviation = math.sqrt((wins * (1 - score) ** 2 + draws * (.5 - score) ** 2 +
+                           losses * score ** 2) / games) / math.sqrt(games)
+    clamp = lambda s: min(max(s, 1e-6), 1 - 1e-6)
+    return (elo(clamp(score)),
+            elo(clamp(score - 1.96 * deviation)), elo(clamp(score + 1.96 * deviation)))
+
+def report(configs, results):
+    baseline = configs[0]['name']
+    totals = dict((c['name'], {'nodes': 0, 'secs': 0.}) for c in configs)
+    matches = defaultdict(lambda: [0, 0, 0])
+    for r in results:
+        for side, name in enumerate((r['white'], r['black'])):
+            totals[name]['nodes'] += r['nodes'][side]
+            totals[name]['secs'] += r['secs'][side]
+        # Results of the challenger against the baseline
+        if r['white'] == baseline:
+            challenger, score = r['black'], 1 - r['result']
+        else:
+            challenger, score = r['white'], r['result']
+        matches[challenger][{1: 0, .5: 1, 0: 2}[score]] += 1
+    for c in configs:
+        name = c['name']
+        nps = totals[name]['nodes'] / totals[name]['secs'] if totals[name]['secs'] else 0
+        line = '%-30s %8d nps' % (name, nps)
+        if name != baseline:
+            wins, draws, losses = matches[name]
+            line += '  +%d =%d -%d' % (wins, draws, losses)
+            diff = elo_difference(wins, draws, losses)
+            if diff is not None:
+                line += '  elo %+.1f [%+.1f, %+.1f]' % diff
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Play engine configurations against each other')
+    parser.add_argument('configs', nargs='+', help='engine[:time control], the first one being the baseline')
+    parser.add_argument('--games', type=int, default=20, help='games of each configuration against the baseline')
+    parser.add_argument('--tc', default='10+0.1', help='base+increment seconds, or Ns per move')
+    parser.add_argument('--openings', default='openings.txt', help='.pgn or move list file')
+    parser.add_argument('--opening-plies', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--table-mb', type=int, default=16, help='transposition table size of each engine')
+    parser.add_argument('--max-plies', type=int, default=300)
+    parser.add_argument('--win-score', type=int, default=1000, help='score both sides agree on to adjudicate a win')
+    parser.add_argument('--draw-score', type=int, default=10)
+    parser.add_argument('--draw-ply', type=int, default=80, help='ply from which dead even games are drawn')
+    parser.add_argument('--adjudicate-moves', type=int, default=4, help='moves a score must hold for')
+    args = parser.parse_args()
+
+    # A single configuration plays itself
+    configs = [parse_config(c, args.tc) for c in args.configs * (2 if len(args.configs) == 1 else 1)]
+    names = set()
+    for n, c in enumerate(configs):
+        if c['name'] in names:
+            c['name'] += ' (%d)' % (n + 1)
+        names.add(c['name'])
+    openings = [game[:args.opening_plies] for game in book.read_games(args.openings)] or [[]]
+    options = {'table_bytes': args.table_mb << 20, 'max_plies': args.max_plies,
+               'win_score': args.win_score, 'draw_score': args.draw_score,
+               'draw_ply': args.draw_ply, 'adjudicate_moves': args.adjudicate_moves}
+    tasks = []
+    number = itertools.count(1)
+    for challenger in configs[1:]:
+        for n in range(args.games):
+            # Each opening once with each colour
+            opening = openings[n // 2 % len(openings)]
+            white, black = (configs[0], challenger) if n % 2 == 0 else (challenger, configs[0])
+            tasks.append((next(number), white, black, opening, options))
+
+    results = []
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for r in pool.imap_unordered(play_game, tasks):
+            results.append(r)
+            print('Game %d: %s - %s %s (%s, %d plies)' % (
+                r['game'], r['white'], r['black'],
+                {1: '1-0', .5: '1/2-1/2', 0: '0-1'}[r['result']], r['reason'], r['plies']),
+                file=sys.stderr)
+    finally:
+        pool.terminate()
+        pool.join()
+    report(configs, results)
+
+if __name__ == '__main__':
+    main()
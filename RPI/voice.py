@@ -1,60 +1,64 @@
 import os
 import sys
 import json
-import hashlib
-import subprocess
-from gtts import gTTS
-import speech_recognition as sr
+import speaker
+import listener
 
 CACHE_DIR = "./tts"
 
-r = sr.Recognizer()
+# The recognizers speech can be recognized by, by name
+RECOGNIZERS = {
+    'google': listener.GoogleRecognizer,
+    'sphinx': listener.SphinxRecognizer,
+}
 
-def init():
-    if os.path.isdir(CACHE_DIR) == False:
-        os.mkdir(CACHE_DIR)
-    with sr.Microphone() as source:
-        print("Calibrating ambient noise level")
-        # listen for 1 second to calibrate the energy threshold for ambient noise levels
-        r.adjust_for_ambient_noise(source)
-        print("Done")
+# The speaker.Speaker saying the phrases, and the listener.Listener hearing the
+# microphone, started by init()
+output = None
+capture = None
 
-def play(path):
-    subprocess.Popen(['mpg123', '-q', path]).wait()
-
-def generateFilename(text):
-    m = hashlib.md5()
-    m.update(text)
-    return CACHE_DIR + "/" + str(m.hexdigest()) + ".mp3"
+# <prompts> and <sounds> are the phrases and mp3 files said often, rendered in
+# the background from now on. When <offline>, phrases are said by the offline
+# stand-in of the text to speech service. Speech is recognized by the
+# <recognizer> named, or given, and heard from <source>, the microphone if None.
+def init(prompts=(), sounds=(), offline=False, recognizer='google', source=None):
+    global output, capture
+    if offline:
+        tts = speaker.OfflineTTS()
+    else:
+        tts = speaker.GoogleTTS(CACHE_DIR)
+    output = speaker.Speaker(tts, speaker.AplaySink())
+    output.prefetch(prompts, sounds)
+    if recognizer in RECOGNIZERS:
+        recognizer = RECOGNIZERS[recognizer]('it-IT')
+    if source is None:
+        source = listener.MicrophoneSource()
+    # Calibrates on the ambient noise of its first second
+    capture = listener.Listener(source, recognizer)
+    capture.start()
 
-def checkCacheFor(text):
-    return os.path.isfile(generateFilename(text))
+def close():
+    output.close()
+    capture.close()
 
-def downloadTTS(text):
-    tts = gTTS(text=text, lang='it')
-    tts.save(generateFilename(text))
+# The board doesn't hear itself while it speaks, and only what is said after it
+# spoke is listened to
+def play(path):
+    capture.mute()
+    try:
+        output.play(path)
+    finally:
+        capture.unmute()
 
 def talk(text, useCache=True, saveCache=True):
-    if useCache == False or checkCacheFor(text) == False:
-        downloadTTS(text)
-    play(generateFilename(text))
+    capture.mute()
+    try:
+        output.talk(text, fresh=not useCache)
+    finally:
+        capture.unmute()
 
+# Returns the text of what is said next, as soon as it is recognized, or None
+# if it couldn't be understood
 def listen():
-    # obtain audio from the microphone
-    with sr.Microphone() as source:
-        print("Now listening")
-        audio = r.listen(source)
-
-    # recognize speech using Google Speech Recognition
-    try:
-        # for testing purposes, we're just using the default API key
-        # to use another API key, use `r.recognize_google(audio, key="GOOGLE_SPEECH_RECOGNITION_API_KEY")`
-        # instead of `r.recognize_google(audio)`
-        text = r.recognize_google(audio, language='it-IT')
-        return text
-    except sr.UnknownValueError:
-        print("Google Speech Recognition could not understand audio")
-        return None
-    except sr.RequestError as e:
-        print("Could not request results from Google Speech Recognition service; {0}".format(e))
-        return None
+    print("Now listening")
+    return capture.listen()